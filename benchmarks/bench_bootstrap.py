@@ -0,0 +1,48 @@
+"""Benchmarks the dependency part of container startup, before and after ensure_requirements.
+
+Before: every job ran one pip install per package, even when the package was already installed.
+After: the installed versions are checked first and pip only runs for the missing requirements.
+Both run offline (pip --no-index) against the packages of the current environment, so the numbers
+are the pip overhead alone, without the downloads a job also paid for on top of it.
+
+Run from the repository root:
+    python -m benchmarks.bench_bootstrap --repeat 3
+"""
+import argparse
+import subprocess
+import sys
+import time
+
+from source_scripts.bootstrap.bootstrap import ensure_requirements, installed_version, requirement_name
+from source_scripts.preprocessing.preprocess import RUNTIME_PACKAGES
+
+
+def pip_install_each(requirements):
+    for requirement in requirements:
+        subprocess.run([sys.executable, "-m", "pip", "install", "--no-index", requirement],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # pinned to the installed versions so that "after" measures the already-installed path
+    requirements = []
+    for requirement in RUNTIME_PACKAGES:
+        name, _ = requirement_name(requirement)
+        version = installed_version(name)
+        if version is not None:
+            requirements.append(f"{name}=={version}")
+    print(f"requirements: {requirements}")
+
+    print(f"{'run':>4} {'before (s)':>12} {'after (s)':>12}")
+    for run in range(args.repeat):
+        start = time.perf_counter()
+        pip_install_each(requirements)
+        before = time.perf_counter() - start
+        start = time.perf_counter()
+        ensure_requirements(requirements, authenticate=lambda: None)
+        after = time.perf_counter() - start
+        print(f"{run:>4} {before:>12.3f} {after:>12.3f}")
@@ -0,0 +1,51 @@
+"""Benchmarks the DuckDB fetch path of preprocess.py offline, on copies of dataset/abalone-dataset.csv.
+
+Run from the repository root:
+    python -m benchmarks.bench_duckdb --copies 1 100 1000
+"""
+import argparse
+import pathlib
+import shutil
+import tempfile
+import time
+
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+from source_scripts.preprocessing.preprocess import (
+    build_select_query, duckdb_relation, fetch_duckdb_arrow, query_predicates
+)
+
+DATASET = pathlib.Path(__file__).resolve().parent.parent / "dataset" / "abalone-dataset.csv"
+
+
+def write_copies(directory, copies, file_format):
+    """Writes the abalone dataset copies times, as one CSV or Parquet file per copy."""
+    table = pv.read_csv(DATASET, read_options=pv.ReadOptions(autogenerate_column_names=True))
+    for i in range(copies):
+        if file_format == "csv":
+            shutil.copy(DATASET, directory / f"part-{i:05d}.csv")
+        else:
+            pq.write_table(table.rename_columns([
+                "sex", "length", "diameter", "height", "whole_weight", "shucked_weight", "viscera_weight",
+                "shell_weight", "rings"]), directory / f"part-{i:05d}.parquet")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--copies", type=int, nargs="+", default=[1, 100, 1000])
+    parser.add_argument("--filter", type=str, default="disabled")
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'format':>8} {'seconds':>10}")
+    for copies in args.copies:
+        for file_format in ("csv", "parquet"):
+            with tempfile.TemporaryDirectory() as directory:
+                directory = pathlib.Path(directory)
+                write_copies(directory, copies, file_format)
+                query = build_select_query(
+                    "duckdb", duckdb_relation(str(directory / f"*.{file_format}")),
+                    predicates=query_predicates("duckdb", rings_filter=args.filter))
+                start = time.perf_counter()
+                table = fetch_duckdb_arrow(query)
+                print(f"{table.num_rows:>10} {file_format:>8} {time.perf_counter() - start:>10.3f}")
@@ -0,0 +1,80 @@
+"""Benchmarks the Snowflake cursor fetch in preprocess.py against the previous concat-per-batch version.
+
+Run from the repository root:
+    python -m benchmarks.bench_fetch --rows 100000 1000000 10000000
+"""
+import argparse
+import time
+import tracemalloc
+from collections import namedtuple
+
+import pandas as pd
+
+from source_scripts.preprocessing.preprocess import fetch_pandas_old
+
+Column = namedtuple("Column", ["name"])
+
+
+class SyntheticCursor:
+    """Minimal DB-API cursor returning n_rows abalone shaped tuples."""
+
+    def __init__(self, n_rows):
+        self.n_rows = n_rows
+        self.position = 0
+        self.description = [Column(name) for name in ["SEX", "LENGTH", "DIAMETER", "HEIGHT", "WHOLE_WEIGHT",
+                                                      "SHUCKED_WEIGHT", "VISCERA_WEIGHT", "SHELL_WEIGHT", "RINGS"]]
+        self.row = ("M", 0.455, 0.365, 0.095, 0.514, 0.2245, 0.101, 0.15, 15)
+
+    def execute(self, sql):
+        self.position = 0
+
+    def fetchmany(self, size):
+        size = min(size, self.n_rows - self.position)
+        self.position += size
+        return [self.row] * size
+
+
+def legacy_fetch_pandas(cur, sql):
+    """The previous implementation, growing the dataset with a pd.concat per 500 rows."""
+    cur.execute(sql)
+    cols = [rmi.name.lower() for rmi in cur.description]
+    dataset = pd.DataFrame()
+    while True:
+        dat = cur.fetchmany(500)
+        if not dat:
+            break
+        df = pd.DataFrame(dat, columns=cols)
+        if dataset.empty:
+            dataset = df
+        else:
+            dataset = pd.concat([dataset, df], ignore_index=True)
+    return dataset
+
+
+def measure(fetch, n_rows):
+    cursor = SyntheticCursor(n_rows)
+    tracemalloc.start()
+    start = time.perf_counter()
+    dataset = fetch(cursor, "SELECT * FROM abalone")
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(dataset) == n_rows
+    return elapsed, peak / 1024 ** 2
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[100000, 1000000, 10000000])
+    parser.add_argument("--legacy-max-rows", type=int, default=1000000,
+                        help="the legacy version is quadratic, skip it above this row count")
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'version':>8} {'seconds':>10} {'peak MiB':>10}")
+    for n_rows in args.rows:
+        versions = [("current", fetch_pandas_old)]
+        if n_rows <= args.legacy_max_rows:
+            versions.append(("legacy", legacy_fetch_pandas))
+        for name, fetch in versions:
+            elapsed, peak = measure(fetch, n_rows)
+            print(f"{n_rows:>10} {name:>8} {elapsed:>10.2f} {peak:>10.1f}")
@@ -0,0 +1,58 @@
+"""Benchmarks the peak RSS of the training preprocessing, the float64 path against the lean float32 one.
+
+Each mode runs in a fresh interpreter so that ru_maxrss only covers that mode. Run from the repository root:
+    python -m benchmarks.bench_preprocess_memory --copies 100 300
+"""
+import argparse
+import pathlib
+import subprocess
+import sys
+import tempfile
+
+DATASET = pathlib.Path(__file__).resolve().parent.parent / "dataset" / "abalone-dataset.csv"
+
+
+def run_mode(mode, copies, output_dir):
+    import numpy as np
+    import pandas as pd
+    from source_scripts.preprocessing.preprocess import (
+        abalone_column_transformer, feature_columns_names, label_column, peak_memory_mb, preprocess_abalone_lean,
+        write_rows
+    )
+    abalone = pd.read_csv(DATASET, header=None, names=feature_columns_names + [label_column])
+    dataset = pd.concat([abalone] * copies, ignore_index=True)
+    del abalone
+    loaded = peak_memory_mb()
+    if mode == "legacy":
+        # preprocess_abalone before the transform plan: fit_transform, concatenate, shuffle, split, to_csv
+        y = dataset.pop(label_column)
+        X_pre = abalone_column_transformer().fit_transform(dataset)
+        X = np.concatenate((y.to_numpy().reshape(len(y), 1), X_pre), axis=1)
+        np.random.shuffle(X)
+        for name, split in zip(("train", "validation", "test"), np.split(X, [int(0.7 * len(X)), int(0.85 * len(X))])):
+            pd.DataFrame(split).to_csv(f"{output_dir}/{name}.csv", header=False, index=False)
+    else:
+        X, splits, _ = preprocess_abalone_lean(dataset)
+        for name, indices in zip(("train", "validation", "test"), splits):
+            write_rows(f"{output_dir}/{name}.csv", X, indices)
+    print(f"{len(dataset)} {loaded:.0f} {peak_memory_mb():.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--copies", type=int, nargs="+", default=[100, 300])
+    parser.add_argument("--mode", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        with tempfile.TemporaryDirectory() as output_dir:
+            run_mode(args.mode, args.copies[0], output_dir)
+        sys.exit(0)
+
+    print(f"{'rows':>10} {'mode':>8} {'data MB':>9} {'peak MB':>9} {'stage MB':>9}")
+    for copies in args.copies:
+        for mode in ("legacy", "lean"):
+            output = subprocess.run([sys.executable, "-m", "benchmarks.bench_preprocess_memory", "--mode", mode,
+                                     "--copies", str(copies)], capture_output=True, text=True, check=True)
+            rows, loaded, peak = output.stdout.split()[-3:]
+            print(f"{rows:>10} {mode:>8} {loaded:>9} {peak:>9} {int(peak) - int(loaded):>9}")
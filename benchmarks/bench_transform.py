@@ -0,0 +1,53 @@
+"""Benchmarks applying the fitted abalone transformers: sklearn ColumnTransformer vs the compiled TransformPlan.
+
+Run from the repository root:
+    python -m benchmarks.bench_transform --copies 1 10 100
+"""
+import argparse
+import pathlib
+import time
+
+import numpy as np
+import pandas as pd
+
+from source_scripts.preprocessing.preprocess import (
+    StreamingPreprocessor, abalone_column_transformer, feature_columns_names, label_column
+)
+
+DATASET = pathlib.Path(__file__).resolve().parent.parent / "dataset" / "abalone-dataset.csv"
+
+
+def sklearn_transform(column_transformer, dataset):
+    """The former preprocess_abalone: transform, then a concatenate to put the label in front."""
+    X_pre = column_transformer.transform(dataset.drop(columns=[label_column]))
+    y_pre = dataset[label_column].to_numpy().reshape(len(dataset), 1)
+    return np.concatenate((y_pre, X_pre), axis=1)
+
+
+def best_of(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--copies", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    abalone = pd.read_csv(DATASET, header=None, names=feature_columns_names + [label_column])
+    column_transformer = abalone_column_transformer().fit(abalone.drop(columns=[label_column]))
+    preprocessor = StreamingPreprocessor.from_column_transformer(column_transformer)
+
+    print(f"{'rows':>10} {'sklearn rows/s':>16} {'plan rows/s':>14} {'speedup':>8}")
+    for copies in args.copies:
+        dataset = pd.concat([abalone] * copies, ignore_index=True)
+        out = np.empty((len(dataset), 1 + preprocessor.plan().width))
+        sklearn_seconds = best_of(lambda: sklearn_transform(column_transformer, dataset), args.repeat)
+        plan_seconds = best_of(lambda: preprocessor.transform(dataset, out=out), args.repeat)
+        print(f"{len(dataset):>10} {len(dataset) / sklearn_seconds:>16,.0f} {len(dataset) / plan_seconds:>14,.0f} "
+              f"{sklearn_seconds / plan_seconds:>7.1f}x")
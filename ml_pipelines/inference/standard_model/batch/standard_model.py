@@ -84,6 +84,9 @@ def standard_model_pipeline(base_job_prefix, default_bucket, env_data, model_pac
                                  processing_instance_type=processing_instance_type,
                                  sagemaker_session=sagemaker_session,
                                  preprocess_script_path="{}/preprocessing/preprocess.py".format(source_scripts_path), #if you instead want to use same as from training use> model_metadata["CustomerMetadataProperties"]["preprocess"],
+                                 bootstrap_path="{}/bootstrap".format(source_scripts_path),
+                                 # transformer fitted by the training, model packages registered before it was saved have none
+                                 preprocessor_path=model_metadata["CustomerMetadataProperties"].get("preprocessor"),
                                  batch_data=batch_data,
                                  database=database,
                                  table=table,
@@ -151,6 +154,7 @@ def standard_model_pipeline(base_job_prefix, default_bucket, env_data, model_pac
                                  processing_instance_type=processing_instance_type,
                                  sagemaker_session=sagemaker_session,
                                  postprocess_script_path="{}/postprocessing/postprocess.py".format(source_scripts_path), #if you instead want to use same as from training use> model_metadata["CustomerMetadataProperties"]["postprocess"],
+                                 bootstrap_path="{}/bootstrap".format(source_scripts_path),
                                  volume_kms_key=volume_kms_key,
                                  output_kms_key=output_kms_key,
                                  processing_role=processing_role,
@@ -306,6 +310,8 @@ def preprocessing(base_job_prefix,
                   processing_instance_type,
                   sagemaker_session,
                   preprocess_script_path,
+                  bootstrap_path,
+                  preprocessor_path,
                   batch_data,
                   volume_kms_key,
                   output_kms_key,
@@ -320,6 +326,9 @@ def preprocessing(base_job_prefix,
                   bydf_param_name
                   ):
     cache_config = CacheConfig(enable_caching=True, expire_after="PT3H")
+    inputs = [ProcessingInput(source=bootstrap_path, destination="/opt/ml/processing/input/bootstrap")]
+    if preprocessor_path:
+        inputs.append(ProcessingInput(source=preprocessor_path, destination="/opt/ml/processing/input/preprocessor"))
 
     # processing step for feature engineering
     sklearn_processor = SKLearnProcessor(
@@ -338,6 +347,7 @@ def preprocessing(base_job_prefix,
         name="Preprocess",
         cache_config=cache_config,
         processor=sklearn_processor,
+        inputs=inputs,
         outputs=[
             ProcessingOutput(output_name="inference",
                              source="/opt/ml/processing/inference-test/",
@@ -442,6 +452,7 @@ def postprocessing(base_job_prefix,
                   processing_instance_type,
                   sagemaker_session,
                   postprocess_script_path,
+                  bootstrap_path,
                   volume_kms_key,
                   output_kms_key,
                   processing_role,
@@ -467,6 +478,9 @@ def postprocessing(base_job_prefix,
     post_process = ProcessingStep(
         name="NotifyDataFoundation",
         processor=sklearn_processor,
+        inputs=[
+            ProcessingInput(source=bootstrap_path, destination="/opt/ml/processing/input/bootstrap"),
+        ],
         code=postprocess_script_path,
         job_arguments=[
             "--context", "postprocess",
@@ -38,6 +38,7 @@ def standard_model_pipeline(base_job_prefix, default_bucket, env_data, model_pac
     model_path = Join(on='/', values=[model_base_path, "model"])
     baseline_path = Join(on='/', values=[model_base_path, "data-monitoring"])
     evaluation_path = Join(on='/', values=[model_base_path, "evaluation"])
+    preprocessor_path = Join(on='/', values=[model_base_path, "preprocessor"])
 
     bydf_param_name = ParameterString(name="BydfParamName", default_value="BringYourOwnDataFoundation")
     #model_path = "s3://{}/lifecycle/max/{}/{}/{}/{}/training".format(env_data["ModelBucketName"], project,  pipeline_name, revision, model_name, time_path)
@@ -65,6 +66,7 @@ def standard_model_pipeline(base_job_prefix, default_bucket, env_data, model_pac
         training_path=Join(on='/', values=[data_base_path, "training"]),
         validation_path=Join(on='/', values=[data_base_path, "validation"]),
         test_path=Join(on='/', values=[data_base_path, "test"]),
+        preprocessor_path=preprocessor_path,
         database=database,
         table=table,
         filter=filter,
@@ -132,7 +134,8 @@ def standard_model_pipeline(base_job_prefix, default_bucket, env_data, model_pac
                                      postprocessing_script,
                                      revision,
                                      source_scripts_path,
-                                     drift_check_baselines)
+                                     drift_check_baselines,
+                                     preprocessor_path)
     # pipeline instance
     pipeline = Pipeline(
         name=pipeline_name,
@@ -184,6 +187,7 @@ def preprocessing(base_job_prefix,
                   training_path,
                   validation_path,
                   test_path,
+                  preprocessor_path,
                   database,
                   table,
                   filter,
@@ -213,6 +217,12 @@ def preprocessing(base_job_prefix,
         name="Preprocess",
         cache_config=cache_config,
         processor=sklearn_processor,
+        inputs=[
+            ProcessingInput(
+                source="{}/bootstrap".format(source_scripts_path),
+                destination="/opt/ml/processing/input/bootstrap",
+            ),
+        ],
         outputs=[
             ProcessingOutput(
                 output_name="raw",
@@ -231,6 +241,11 @@ def preprocessing(base_job_prefix,
             ProcessingOutput(output_name="test",
                              source="/opt/ml/processing/test",
                              destination=test_path
+                             ),
+            # fitted transformer parameters, the inference transforms with them instead of re-fitting
+            ProcessingOutput(output_name="preprocessor",
+                             source="/opt/ml/processing/preprocessor",
+                             destination=preprocessor_path
                              )
         ],
         code = preprocessing_script,
@@ -442,7 +457,7 @@ def evaluation_tasks(base_job_prefix, env_data, image_uri, network_config, proce
 
 def model_register_tasks(evaluation_report, model_approval_status, model_metrics, model_package_group_name,
                          network_config, step_eval, step_train, xgb_train, preprocessing_script, postprocessing_script, revision, source_scripts_path,
-                         drift_check_baselines):
+                         drift_check_baselines, preprocessor_path):
     """
     There is a bug in RegisterModel implementation
     The RegisterModel step is implemented in the SDK as two steps, a _RepackModelStep and a _RegisterModelStep.
@@ -476,6 +491,7 @@ def model_register_tasks(evaluation_report, model_approval_status, model_metrics
         customer_metadata_properties={
             "preprocess" : preprocessing_script,
             "postprocess" : postprocessing_script,
+            "preprocessor" : preprocessor_path,
             "git_revision" : revision,
             "pipeline_execution_id" : ExecutionVariables.PIPELINE_EXECUTION_ID ,
             "pipeline_execution_arn" : ExecutionVariables.PIPELINE_EXECUTION_ARN
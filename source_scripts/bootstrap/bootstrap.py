@@ -0,0 +1,254 @@
+"""
+Container startup shared by the processing scripts: installs the runtime packages that are not importable yet
+and runs the startup tasks concurrently.
+Nothing runs on import, the scripts call ensure_requirements from their main.
+
+The processing steps ship this directory as a ProcessingInput to BOOTSTRAP_DIR, the scripts add it to sys.path.
+"""
+import hashlib
+import importlib
+import logging
+import pathlib
+import platform
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+BOOTSTRAP_DIR = "/opt/ml/processing/input/bootstrap"
+
+
+# To easily add packages at runtime from codeartifact, you can use this method. A more graceful way is to install packages in
+# a container and use that container as the processing container.
+# @todo adjust hardcoded values into fetching from ssm parameters.
+def auth_codeartifact(mlops_domain='cirrus-ml-ds-domain', domain_owner='813736554012', repository='cirrus-ml-ds-shared-repo',
+                    region='eu-north-1', client=None):
+    # fetches temporary credentials with boto3 from codeartifact, creates the index_url for the pip config
+    # and finally uses the index_url (url with token included) to update the global pip config
+    # when pip install is run, this means that pip install will utilize codeartifact instead of trying to reach public pypi
+    boto3_config = Config(
+        region_name = 'eu-north-1',
+        signature_version = 'v4',
+        retries = {
+            'max_attempts': 10,
+            'mode': 'standard'
+        }
+    )
+    if client is None:
+        client = boto3.client('codeartifact',config=boto3_config)
+    codeartifact_token = client.get_authorization_token(
+        domain=mlops_domain,
+        domainOwner=domain_owner,
+        durationSeconds=10000
+    )
+    pip_index_url = f'https://aws:{codeartifact_token["authorizationToken"]}@{mlops_domain}-{domain_owner}.d.codeartifact.{region}.amazonaws.com/pypi/{repository}/simple/'
+    subprocess.run(["pip", "config", "set", "global.index-url", pip_index_url],
+                   capture_output=True)
+
+
+def pip(*arguments):
+    command = [sys.executable, "-m", "pip", *arguments]
+    with subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=1, universal_newlines=True) as p:
+        for line in p.stdout:
+            print(line, end='')
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, command)
+
+
+def install(*packages):
+    pip("install", *packages)
+
+
+def requirement_name(requirement):
+    """Distribution name and pinned version (None when unpinned) of a "name" or "name==version" requirement."""
+    name, _, version = requirement.partition("==")
+    return name.split("[")[0].strip(), version.strip() or None
+
+
+def installed_version(name):
+    try:
+        from importlib import metadata
+    except ImportError:  # Python 3.7 in the sklearn 0.23-1 container
+        import pkg_resources
+        try:
+            return pkg_resources.get_distribution(name).version
+        except pkg_resources.DistributionNotFound:
+            return None
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def missing_requirements(requirements):
+    """The requirements not installed at all or installed at another version than the pinned one."""
+    missing = []
+    for requirement in requirements:
+        name, version = requirement_name(requirement)
+        installed = installed_version(name)
+        if installed is None or (version is not None and installed != version):
+            missing.append(requirement)
+    return missing
+
+
+def requirements_hash(requirements):
+    """Wheelhouse key, wheels only fit the Python version and platform they were built for."""
+    content = "\n".join(sorted(requirement.strip().lower() for requirement in requirements))
+    content += f"\n{sys.version_info.major}.{sys.version_info.minor}-{platform.machine()}"
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+
+class Wheelhouse:
+    """Archives of pre-built wheels stored as <root>/<requirements hash>.tar.gz, root is an s3:// or a local path."""
+
+    def __init__(self, root):
+        self.root = root.rstrip("/")
+
+    def path(self, key):
+        return f"{self.root}/{key}.tar.gz"
+
+    def download(self, key, directory):
+        """Extracts the wheels of key into directory, False when they are not cached yet."""
+        archive = pathlib.Path(directory) / f"{key}.tar.gz"
+        if self.root.startswith("s3://"):
+            bucket, _, prefix = self.path(key)[len("s3://"):].partition("/")
+            s3 = boto3.client("s3")
+            try:
+                s3.download_file(bucket, prefix, str(archive))
+            except ClientError:
+                return False
+        elif pathlib.Path(self.path(key)).exists():
+            shutil.copyfile(self.path(key), archive)
+        else:
+            return False
+        with tarfile.open(archive) as tar:
+            tar.extractall(directory)
+        archive.unlink()
+        return True
+
+    def upload(self, key, directory):
+        with tempfile.TemporaryDirectory() as scratch:
+            archive = pathlib.Path(scratch) / f"{key}.tar.gz"
+            with tarfile.open(archive, "w:gz") as tar:
+                for wheel in pathlib.Path(directory).iterdir():
+                    tar.add(wheel, arcname=wheel.name)
+            if self.root.startswith("s3://"):
+                bucket, _, prefix = self.path(key)[len("s3://"):].partition("/")
+                boto3.client("s3").upload_file(str(archive), bucket, prefix)
+            else:
+                pathlib.Path(self.root).mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(archive, self.path(key))
+
+
+def ensure_requirements(requirements, wheelhouse=None, authenticate=auth_codeartifact):
+    """
+    Installs the requirements that are not importable at the right version yet.
+    With a wheelhouse root, they are installed offline from the wheels cached for the same requirements, or
+    built from the index once and cached for the next jobs. authenticate only runs when the index is needed.
+    Returns the timings of the steps and where the packages came from: "installed", "wheelhouse" or "index".
+    """
+    started = time.perf_counter()
+    timings = {}
+    missing = missing_requirements(requirements)
+    timings["check_seconds"] = time.perf_counter() - started
+    if not missing:
+        timings["source"] = "installed"
+        logger.info(f"Requirements already installed: {requirements}")
+        return timings
+
+    logger.info(f"Installing missing requirements: {missing}")
+    key = requirements_hash(missing)
+    cache = Wheelhouse(wheelhouse) if wheelhouse else None
+    with tempfile.TemporaryDirectory() as directory:
+        step_started = time.perf_counter()
+        if cache is not None and cache.download(key, directory):
+            timings["download_seconds"] = time.perf_counter() - step_started
+            timings["source"] = "wheelhouse"
+        elif cache is not None:
+            authenticate()
+            pip("wheel", "--wheel-dir", directory, *missing)
+            timings["build_seconds"] = time.perf_counter() - step_started
+            timings["source"] = "index"
+            try:
+                cache.upload(key, directory)
+            except Exception:
+                logger.info(f"Could not cache the wheels in {wheelhouse}")
+        else:
+            authenticate()
+            install(*missing)
+            timings["install_seconds"] = time.perf_counter() - step_started
+            timings["source"] = "index"
+        if cache is not None:
+            step_started = time.perf_counter()
+            install("--no-index", "--find-links", directory, *missing)
+            timings["install_seconds"] = time.perf_counter() - step_started
+    importlib.invalidate_caches()
+    timings["total_seconds"] = time.perf_counter() - started
+    logger.info(f"Requirements bootstrap: {timings}")
+    return timings
+
+
+class Bootstrap:
+    """
+    Runs the container startup tasks concurrently, each one as soon as the tasks it depends on are done,
+    so the SSM reads and the data query don't wait for the package installs they don't need.
+    A task receives the results of its dependencies as keyword arguments.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+        self.timings = {}
+        self.wall_seconds = None
+
+    def add(self, name, function, depends_on=()):
+        missing = [dependency for dependency in depends_on if dependency not in self.tasks]
+        if missing:
+            raise ValueError(f"Bootstrap task {name} depends on {missing}, add them first")
+        self.tasks[name] = (function, tuple(depends_on))
+        return self
+
+    def run(self):
+        """Runs all tasks and returns their results by name, re-raising the first failure."""
+        started = time.perf_counter()
+        futures = {}
+
+        def run_task(name, function, depends_on):
+            kwargs = {dependency: futures[dependency].result() for dependency in depends_on}
+            start = time.perf_counter() - started
+            try:
+                return function(**kwargs)
+            finally:
+                self.timings[name] = (start, time.perf_counter() - started)
+
+        # one thread per task, a task blocked on its dependencies never holds up an independent one
+        with ThreadPoolExecutor(max_workers=max(len(self.tasks), 1)) as executor:
+            for name, (function, depends_on) in self.tasks.items():
+                futures[name] = executor.submit(run_task, name, function, depends_on)
+        self.wall_seconds = time.perf_counter() - started
+        return {name: future.result() for name, future in futures.items()}
+
+    def summary(self):
+        sequential = sum(end - start for start, end in self.timings.values())
+        return {
+            "tasks": dict(self.timings),
+            "wall_seconds": self.wall_seconds,
+            "sequential_seconds": sequential,
+            "overlap_seconds": sequential - self.wall_seconds,
+        }
+
+    def log_timings(self):
+        summary = self.summary()
+        for name, (start, end) in sorted(summary["tasks"].items(), key=lambda item: item[1][0]):
+            logger.info(f"Bootstrap {name}: {start:.2f}s -> {end:.2f}s ({end - start:.2f}s)")
+        logger.info(f"Bootstrap wall clock {summary['wall_seconds']:.2f}s, "
+                    f"sequential {summary['sequential_seconds']:.2f}s, "
+                    f"overlap saved {summary['overlap_seconds']:.2f}s")
@@ -8,6 +8,7 @@ import tempfile
 import json
 import sys
 import subprocess
+import importlib
 
 import botocore
 import boto3
@@ -29,44 +30,43 @@ logger.addHandler(logging.StreamHandler())
 
 boto3.setup_default_session(region_name="eu-north-1")
 
-def auth_codeartifact(mlops_domain='cirrus-ml-ds-domain', domain_owner='813736554012', repository='cirrus-ml-ds-shared-repo',
-                    region='eu-north-1'):
-    # fetches temporary credentials with boto3 from codeartifact, creates the index_url for the pip config
-    # and finally uses the index_url (url with token included) to update the global pip config
-    # when pip install is run, this means that pip install will utilize codeartifact instead of trying to reach public pypi
-    boto3_config = Config(
-        region_name = 'eu-north-1',
-        signature_version = 'v4',
-        retries = {
-            'max_attempts': 10,
-            'mode': 'standard'
-        }
-    )
-    client = boto3.client('codeartifact',config=boto3_config)
-    codeartifact_token = client.get_authorization_token(
-        domain=mlops_domain,
-        domainOwner=domain_owner,
-        durationSeconds=10000
-    )
-    codeartifact_token["authorizationToken"]
-    pip_index_url = f'https://aws:{codeartifact_token["authorizationToken"]}@{mlops_domain}-{domain_owner}.d.codeartifact.{region}.amazonaws.com/pypi/{repository}/simple/'
-    subprocess.run(["pip", "config", "set", "global.index-url", pip_index_url],
-                   capture_output=True)
-
-def install(package):
-    command = ["pip", "install", package]
-    with subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=1, universal_newlines=True) as p:
-        for line in p.stdout:
-            print(line, end='')
-
-auth_codeartifact()
-install("awswrangler")
-install("snowflake-sqlalchemy==1.4.7")
-install("sqlalchemy==1.4.47")
-
-import awswrangler as wr
-from sqlalchemy import create_engine
-from snowflake.sqlalchemy import URL
+try:
+    from source_scripts.bootstrap.bootstrap import Bootstrap, auth_codeartifact, ensure_requirements
+except ImportError:  # in the processing container the bootstrap directory is shipped as a ProcessingInput
+    sys.path.insert(0, "/opt/ml/processing/input/bootstrap")
+    from bootstrap import Bootstrap, auth_codeartifact, ensure_requirements
+
+
+# Installed by ensure_requirements when not importable at these versions, only the snowflake target needs them.
+RUNTIME_PACKAGES = [
+    "awswrangler",
+    "snowflake-sqlalchemy==1.4.7",
+    "sqlalchemy==1.4.47",
+]
+wr = create_engine = URL = None
+
+
+def import_runtime_packages():
+    """Imports the runtime packages into the module namespace, the ones not installed yet stay None."""
+    global wr, create_engine, URL
+    importlib.invalidate_caches()
+    try:
+        import awswrangler as wr
+    except ImportError:
+        pass
+    try:
+        from sqlalchemy import create_engine
+        from snowflake.sqlalchemy import URL
+    except ImportError:
+        pass
+
+
+import_runtime_packages()
+
+
+def data_bucket_name(env_type):
+    ssm = boto3.client('ssm', region_name='eu-north-1')
+    return ssm.get_parameter(Name=f"mlops-{env_type}-data-bucket-name")['Parameter']['Value']
 
 
 def exist_ssm_param(param_name: str) -> bool:
@@ -96,13 +96,29 @@ if __name__ == "__main__":
     
     print(args)
 
+    # clients are created up front, creating them is not thread safe while calling them is
     ssm = boto3.client('ssm', region_name="eu-north-1")
+    sts_client = boto3.client('sts')
+    events = boto3.client('events', region_name='eu-north-1')
+    codeartifact = boto3.client('codeartifact', config=Config(region_name='eu-north-1', signature_version='v4',
+                                                              retries={'max_attempts': 10, 'mode': 'standard'}))
     source_account=args.sourceaccount
-    env_type=ssm.get_parameter(Name='EnvType')['Parameter']['Value']
-
-    if args.bydf_param_name and exist_ssm_param(param_name=args.bydf_param_name):
-        bydf = json.loads(ssm.get_parameter(Name=args.bydf_param_name)['Parameter']['Value'])
 
+    def install_packages(env_type, bydf):
+        wheelhouse = (bydf or {}).get("wheelhouse_path", f"s3://{data_bucket_name(env_type)}/wheelhouse")
+        timings = ensure_requirements(RUNTIME_PACKAGES, wheelhouse=wheelhouse,
+                                      authenticate=lambda: auth_codeartifact(client=codeartifact))
+        import_runtime_packages()
+        return timings
+
+    def load_bydf():
+        if args.bydf_param_name and exist_ssm_param(param_name=args.bydf_param_name):
+            return json.loads(ssm.get_parameter(Name=args.bydf_param_name)['Parameter']['Value'])
+        return None
+
+    def notify(env_type, bydf):
+        if bydf is None:
+            return
         if bydf['target'] == 'kinesis': # use data foundation kinesis setup
             source_env = env_type
             if env_type == "exp":
@@ -112,7 +128,6 @@ if __name__ == "__main__":
             STREAM_NAME = f"{team_name}-ml-integration"
             ASSUMED_ROLE = f"arn:aws:iam::{source_account}:role/{team_name}-{source_env}-ml-integration-role"
 
-            sts_client = boto3.client('sts')
             assumed_role_object = sts_client.assume_role(
                 RoleArn=ASSUMED_ROLE,
                 RoleSessionName="ml-kinesis-access"
@@ -140,8 +155,7 @@ if __name__ == "__main__":
                         Data=json.dumps(data),
                         PartitionKey=triggerid)
         if bydf['target'] == "eb":
-            account_id = boto3.client('sts').get_caller_identity().get('Account')
-            events = boto3.client('events', region_name='eu-north-1')
+            account_id = sts_client.get_caller_identity().get('Account')
 
             event_bus_arn = f'arn:aws:events:eu-north-1:{account_id}:event-bus/ml-event-bus'
 
@@ -157,13 +171,24 @@ if __name__ == "__main__":
             }
 
             events.put_events(Entries=[event])
-        if bydf['target'] == "snowflake":
-            print(args.inferenceoutput)
-            df = wr.s3.read_csv(path=args.inferenceoutput)
-            df.columns = ["id","date","result"]
-            print(df)
-            engine = create_engine(URL(**bydf['connection_parameters']))
-            df.to_sql('inference_results', con=engine, index=False, if_exists='append')
 
+    def write_snowflake(packages, bydf):
+        if bydf is None or bydf['target'] != "snowflake":
+            return
+        print(args.inferenceoutput)
+        df = wr.s3.read_csv(path=args.inferenceoutput)
+        df.columns = ["id","date","result"]
+        print(df)
+        engine = create_engine(URL(**bydf['connection_parameters']))
+        df.to_sql('inference_results', con=engine, index=False, if_exists='append')
+
+    bootstrap = Bootstrap()
+    bootstrap.add("env_type", lambda: ssm.get_parameter(Name='EnvType')['Parameter']['Value'])
+    bootstrap.add("bydf", load_bydf)
+    bootstrap.add("packages", install_packages, depends_on=["env_type", "bydf"])
+    bootstrap.add("notify", notify, depends_on=["env_type", "bydf"])
+    bootstrap.add("snowflake", write_snowflake, depends_on=["packages", "bydf"])
+    bootstrap.run()
+    bootstrap.log_timings()
 
     logger.info(">>> End postprocessing.")
@@ -6,59 +6,72 @@ import pathlib
 import subprocess
 import sys
 import json
+import io
+import hashlib
+import importlib
+import re
+import resource
+import shutil
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 from botocore.config import Config
 
-# To easily add packages at runtime from codeartifact, you can use this method. A more graceful way is to install packages in
-# a container and use that container as the processing container.
-# @todo adjust hardcoded values into fetching from ssm parameters.
-def auth_codeartifact(mlops_domain='cirrus-ml-ds-domain', domain_owner='813736554012', repository='cirrus-ml-ds-shared-repo',
-                    region='eu-north-1'):
-    # fetches temporary credentials with boto3 from codeartifact, creates the index_url for the pip config
-    # and finally uses the index_url (url with token included) to update the global pip config
-    # when pip install is run, this means that pip install will utilize codeartifact instead of trying to reach public pypi
-    boto3_config = Config(
-        region_name = 'eu-north-1',
-        signature_version = 'v4',
-        retries = {
-            'max_attempts': 10,
-            'mode': 'standard'
-        }
-    )
-    client = boto3.client('codeartifact',config=boto3_config)
-    codeartifact_token = client.get_authorization_token(
-        domain=mlops_domain,
-        domainOwner=domain_owner,
-        durationSeconds=10000
-    )
-    codeartifact_token["authorizationToken"]
-    pip_index_url = f'https://aws:{codeartifact_token["authorizationToken"]}@{mlops_domain}-{domain_owner}.d.codeartifact.{region}.amazonaws.com/pypi/{repository}/simple/'
-    subprocess.run(["pip", "config", "set", "global.index-url", pip_index_url],
-                   capture_output=True)
-
-def install(package):
-    command = ["pip", "install", package]
-    with subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=1, universal_newlines=True) as p:
-        for line in p.stdout:
-            print(line, end='')
-
-auth_codeartifact()
-install("awswrangler")
-install("snowflake-connector-python==3.0.3")
-# install("snowflake-snowpark-python==1.4.0") Needs Python3.8.*
-install("snowflake-sqlalchemy==1.4.7")
-install("sqlalchemy==1.4.47")
-
-
-import awswrangler as wr
+try:
+    from source_scripts.bootstrap.bootstrap import Bootstrap, auth_codeartifact, ensure_requirements
+except ImportError:  # in the processing container the bootstrap directory is shipped as a ProcessingInput
+    sys.path.insert(0, "/opt/ml/processing/input/bootstrap")
+    from bootstrap import Bootstrap, auth_codeartifact, ensure_requirements
+
+
+# Installed by ensure_requirements when not importable at these versions, the processing container only ships
+# numpy, pandas, scikit-learn and boto3.
+# snowflake-snowpark-python==1.4.0 Needs Python3.8.*
+RUNTIME_PACKAGES = [
+    "awswrangler",
+    "snowflake-connector-python==3.0.3",
+    "snowflake-sqlalchemy==1.4.7",
+    "sqlalchemy==1.4.47",
+    "duckdb",
+]
+wr = pa = pq = duckdb = snowflake = FIELD_ID_TO_NAME = None
+
+
+def import_runtime_packages():
+    """Imports the runtime packages into the module namespace, the ones not installed yet stay None."""
+    global wr, pa, pq, duckdb, snowflake, FIELD_ID_TO_NAME
+    importlib.invalidate_caches()
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        pass
+    try:
+        import awswrangler as wr
+    except ImportError:
+        pass
+    try:
+        import duckdb
+    except ImportError:
+        pass
+    try:
+        import snowflake.connector
+        from snowflake.connector.constants import FIELD_ID_TO_NAME
+    except ImportError:
+        pass
+
+
+import_runtime_packages()
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
 import numpy as np
 import pandas as pd
-import snowflake.connector
 from sklearn.compose import ColumnTransformer
 from sklearn.impute import SimpleImputer
 from sklearn.pipeline import Pipeline
@@ -77,11 +90,34 @@ feature_columns_names = [
 label_column = "rings"
 
 
-def preprocess_abalone(abalone_dataset):
-    logger.info("Reading downloaded data.")
-    df = abalone_dataset
+SPLIT_FRACTIONS = (("train", 0.7), ("validation", 0.15), ("test", 0.15))
 
-    logger.info("Defining transformers.")
+
+def split_hashes(df, key_columns=None):
+    """Stable 64-bit hash per row of key_columns, by default all the raw feature and label columns."""
+    columns = list(key_columns) if key_columns else feature_columns_names + [label_column]
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+
+
+def hash_buckets(hashes, fractions=SPLIT_FRACTIONS):
+    """Split number of each hash, from its position in [0, 1) against the cumulative fractions (0.7, 0.85)."""
+    boundaries = np.cumsum([fraction for _, fraction in fractions])[:-1]
+    return np.searchsorted(boundaries, hashes / 2.0 ** 64, side="right")
+
+
+def hash_split_indices(df, key_columns=None, fractions=SPLIT_FRACTIONS):
+    """
+    Row indices of each split, ordered by row hash. A row always lands in the same split whatever the other
+    rows and their order, so reruns on unchanged data give identical splits and new rows only append to them.
+    """
+    hashes = split_hashes(df, key_columns)
+    order = np.argsort(hashes, kind="stable")
+    buckets = hash_buckets(hashes[order], fractions)
+    return [order[buckets == index] for index in range(len(fractions))]
+
+
+def abalone_column_transformer():
+    """Unfitted imputer, scaler and one-hot encoder of the abalone features."""
     numeric_features = list(feature_columns_names)
     numeric_features.remove("sex")
     numeric_transformer = Pipeline(
@@ -94,48 +130,1246 @@ def preprocess_abalone(abalone_dataset):
             ("onehot", OneHotEncoder(handle_unknown="ignore")),
         ]
     )
-    preprocess = ColumnTransformer(
+    return ColumnTransformer(
         transformers=[
             ("num", numeric_transformer, numeric_features),
             ("cat", categorical_transformer, categorical_features),
         ]
     )
+
+
+def preprocess_abalone(abalone_dataset, return_preprocessor=False, split_key=None):
+    """
+    Fits the transformers on the whole dataset and splits it 70/15/15 by hash of the split_key columns.
+    With return_preprocessor, also returns the fitted parameters as a StreamingPreprocessor, to be saved
+    for the transform-only inference.
+    """
+    logger.info("Reading downloaded data.")
+    df = abalone_dataset
+
+    logger.info("Defining transformers.")
+    preprocess = abalone_column_transformer()
+    split_indices = hash_split_indices(df, split_key)
     logger.info("Applying transforms.")
     y = df.pop("rings")
-    X_pre = preprocess.fit_transform(df)
-    y_pre = y.to_numpy().reshape(len(y), 1)
-    X = np.concatenate((y_pre, X_pre), axis=1)
+    preprocess.fit(df)
+    # the fitted parameters applied in one pass into the output matrix, see TransformPlan
+    preprocessor = StreamingPreprocessor.from_column_transformer(preprocess)
+    X = preprocessor.transform(df, label=y)
     logger.info("Splitting %d rows of data into train, validation, test datasets.", len(X))
-    np.random.shuffle(X)
-    return np.split(X, [int(0.7 * len(X)), int(0.85 * len(X))])
+    splits = [X[indices] for indices in split_indices]
+    if return_preprocessor:
+        return splits, preprocessor
+    return splits
+
 
-def fetch_pandas_old(cur, sql):
+class QuantileSketch:
+    """
+    Mergeable quantile sketch of a numeric stream (a KLL-style compactor hierarchy): level i holds values of
+    weight 2**i, a level growing past capacity is sorted and every other value is promoted to the next level.
+    Memory stays around capacity * log2(n / capacity) values, ranks are off by about n / capacity at most.
+    Until capacity values were added nothing is compacted and quantiles are exact (np.quantile).
+    """
+
+    def __init__(self, capacity=65536, seed=0):
+        self.capacity = capacity
+        self.levels = [np.empty(0)]
+        self.random = np.random.RandomState(seed)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        self.levels[0] = np.concatenate([self.levels[0], values[~np.isnan(values)]])
+        self._compact()
+        return self
+
+    def merge(self, other):
+        for level, values in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self._compact()
+        return self
+
+    def _compact(self):
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self.capacity:
+                values = np.sort(self.levels[level])
+                # an odd value out stays at its level, the rest is halved with a random offset
+                kept, values = values[len(values) - len(values) % 2:], values[:len(values) - len(values) % 2]
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                self.levels[level] = kept
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], values[self.random.randint(2)::2]])
+            level += 1
+
+    def count(self):
+        return sum(len(values) * 2 ** level for level, values in enumerate(self.levels))
+
+    def quantile(self, q):
+        if self.count() == 0:
+            return np.nan
+        if len(self.levels) == 1:
+            return float(np.quantile(self.levels[0], q))
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(values), 2 ** level) for level, values in enumerate(self.levels)])
+        order = np.argsort(values, kind="mergesort")
+        ranks = np.cumsum(weights[order])
+        return float(values[order][np.searchsorted(ranks, q * ranks[-1])])
+
+
+class StreamingPreprocessor:
+    """
+    Out-of-core equivalent of the ColumnTransformer of preprocess_abalone, fitted one chunk at a time with
+    partial_fit and finish, then applied one chunk at a time with transform:
+        - median imputer: a QuantileSketch per numeric column
+        - StandardScaler: count, mean and sum of squared deviations per column, merged chunk by chunk
+        - OneHotEncoder: categories (missing values as "missing") collected during the fit, unknown ones ignored
+    transform gives the columns of the in-memory path: rings, the scaled numeric features and the one-hot sex.
+    """
+
+    def __init__(self, numeric_features=None, categorical_features=("sex",), sketch_capacity=65536):
+        self.numeric_features = list(numeric_features) if numeric_features is not None else \
+            [column for column in feature_columns_names if column not in categorical_features]
+        self.categorical_features = list(categorical_features)
+        self.sketches = {column: QuantileSketch(sketch_capacity) for column in self.numeric_features}
+        self.moments = {column: (0, 0.0, 0.0) for column in self.numeric_features}
+        self.category_sets = {column: set() for column in self.categorical_features}
+        self.n_rows = 0
+        self.medians = self.means = self.scales = self.categories = None
+        self._plan = None
+
+    def partial_fit(self, chunk):
+        for column in self.numeric_features:
+            values = chunk[column].to_numpy(dtype=float)
+            values = values[~np.isnan(values)]
+            self.sketches[column].update(values)
+            if len(values):
+                self.moments[column] = merge_moments(self.moments[column], (
+                    len(values), values.mean(), float(((values - values.mean()) ** 2).sum())))
+        for column in self.categorical_features:
+            self.category_sets[column].update(chunk[column].fillna("missing").unique())
+        self.n_rows += len(chunk)
+        return self
+
+    @classmethod
+    def fit_frame(cls, df):
+        """
+        Exact fit on an in-memory DataFrame, one column at a time with pandas reductions, without the
+        intermediate matrices of the sklearn pipelines.
+        """
+        preprocessor = cls()
+        preprocessor.n_rows = len(df)
+        for column in preprocessor.numeric_features:
+            values = df[column]
+            count = int(values.count())
+            if count:
+                preprocessor.moments[column] = (count, float(values.mean()), float(values.var(ddof=0)) * count)
+        for column in preprocessor.categorical_features:
+            preprocessor.category_sets[column].update(df[column].fillna("missing").unique())
+        return preprocessor.finish(medians={column: float(df[column].median())
+                                            for column in preprocessor.numeric_features})
+
+    def finish(self, medians=None):
+        """
+        Derives the imputer, scaler and encoder parameters once every chunk went through partial_fit,
+        from the quantile sketches unless exact medians are given.
+        """
+        self.medians, self.means, self.scales = {}, {}, {}
+        for column in self.numeric_features:
+            median = medians[column] if medians is not None else self.sketches[column].quantile(0.5)
+            observed = self.moments[column]
+            # the imputed rows enter the scaler statistics with the median value
+            n, mean, m2 = merge_moments(observed, (self.n_rows - observed[0], median, 0.0))
+            scale = np.sqrt(m2 / n) if n else 1.0
+            self.medians[column] = median
+            self.means[column] = mean
+            self.scales[column] = scale if scale > 0 else 1.0
+        self.categories = {column: sorted(values) for column, values in self.category_sets.items()}
+        self._plan = None
+        return self
+
+    @classmethod
+    def from_column_transformer(cls, column_transformer):
+        """The parameters of the ColumnTransformer fitted by preprocess_abalone."""
+        numeric = column_transformer.named_transformers_["num"].named_steps
+        categorical = column_transformer.named_transformers_["cat"].named_steps
+        preprocessor = cls(numeric_features=column_transformer.transformers_[0][2],
+                           categorical_features=column_transformer.transformers_[1][2])
+        preprocessor.medians = dict(zip(preprocessor.numeric_features, numeric["imputer"].statistics_.tolist()))
+        preprocessor.means = dict(zip(preprocessor.numeric_features, numeric["scaler"].mean_.tolist()))
+        preprocessor.scales = dict(zip(preprocessor.numeric_features, numeric["scaler"].scale_.tolist()))
+        preprocessor.categories = {column: [str(value) for value in values] for column, values
+                                   in zip(preprocessor.categorical_features, categorical["onehot"].categories_)}
+        return preprocessor
+
+    def save(self, path):
+        """Writes the fitted parameters as json, the artifact the inference transforms with."""
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        pathlib.Path(path).write_text(json.dumps({
+            "numeric_features": self.numeric_features,
+            "categorical_features": self.categorical_features,
+            "medians": self.medians,
+            "means": self.means,
+            "scales": self.scales,
+            "categories": self.categories,
+        }, indent=2))
+
+    @classmethod
+    def load(cls, path):
+        parameters = json.loads(pathlib.Path(path).read_text())
+        preprocessor = cls(numeric_features=parameters["numeric_features"],
+                           categorical_features=parameters["categorical_features"])
+        preprocessor.medians = parameters["medians"]
+        preprocessor.means = parameters["means"]
+        preprocessor.scales = parameters["scales"]
+        preprocessor.categories = parameters["categories"]
+        return preprocessor
+
+    def plan(self):
+        if self._plan is None:
+            self._plan = TransformPlan(self)
+        return self._plan
+
+    def transform(self, chunk, label=None, out=None):
+        """rings (or label) followed by the features of chunk, written into out when given."""
+        return self.plan().apply(chunk, label=chunk[label_column] if label is None else label, out=out)
+
+    def features(self, chunk, out=None):
+        """transform without the label column, the chunk may not have one."""
+        return self.plan().apply(chunk, out=out)
+
+
+class TransformPlan:
+    """
+    The fitted parameters of a StreamingPreprocessor compiled to arrays and applied in one vectorized pass:
+    the numeric columns are copied into their slice of a preallocated output and imputed, centred and scaled
+    in place, the one-hot columns are set by category index. No intermediate matrix per pipeline stage.
+    """
+
+    def __init__(self, preprocessor):
+        self.numeric_features = list(preprocessor.numeric_features)
+        self.medians = np.array([preprocessor.medians[column] for column in self.numeric_features], dtype=float)
+        self.means = np.array([preprocessor.means[column] for column in self.numeric_features], dtype=float)
+        self.scales = np.array([preprocessor.scales[column] for column in self.numeric_features], dtype=float)
+        self.categorical = []
+        offset = len(self.numeric_features)
+        for column in preprocessor.categorical_features:
+            categories = list(preprocessor.categories[column])
+            self.categorical.append((column, categories, offset))
+            offset += len(categories)
+        self.width = offset
+
+    def apply(self, chunk, label=None, out=None, dtype=np.float64):
+        first = 0 if label is None else 1
+        if out is None:
+            out = np.empty((len(chunk), first + self.width), dtype=dtype)
+        if label is not None:
+            out[:, 0] = label
+        numeric = out[:, first:first + len(self.numeric_features)]
+        for index, column in enumerate(self.numeric_features):
+            numeric[:, index] = chunk[column].to_numpy(dtype=float)
+        missing = np.isnan(numeric)
+        if missing.any():
+            np.copyto(numeric, np.broadcast_to(self.medians, numeric.shape), where=missing)
+        numeric -= self.means
+        numeric /= self.scales
+        onehot = out[:, first + len(self.numeric_features):]
+        onehot.fill(0.0)
+        for column, categories, offset in self.categorical:
+            # unknown categories get code -1 and stay all zeros, like handle_unknown="ignore"
+            codes = pd.Categorical(chunk[column].fillna("missing"), categories=categories).codes
+            rows = np.flatnonzero(codes >= 0)
+            out[rows, first + offset + codes[rows]] = 1.0
+        return out
+
+
+def transform_abalone(chunks, preprocessor, output_path):
+    """Transform-only inference: every row of every chunk, in order, no fit, shuffle or split. Returns the row count."""
+    rows = 0
+    pathlib.Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "w") as output:
+        for chunk in chunks:
+            pd.DataFrame(preprocessor.features(chunk)).to_csv(output, header=False, index=False)
+            rows += len(chunk)
+    logger.info(f"Transformed {rows} rows with the training preprocessor")
+    return rows
+
+
+def merge_moments(a, b):
+    """Merges (count, mean, sum of squared deviations) of two samples (Chan et al. parallel variance)."""
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    if n == 0:
+        return 0, 0.0, 0.0
+    delta = mean_b - mean_a
+    return n, mean_a + delta * n_b / n, m2_a + m2_b + delta ** 2 * n_a * n_b / n
+
+
+def preprocess_abalone_lean(abalone_dataset, dtype=np.float32, split_key=None):
+    """
+    Memory-lean preprocess_abalone: an exact fit column by column, one preallocated dtype matrix with the label
+    in column 0, and the 70/15/15 splits as row indices (hash_split_indices) instead of a shuffled copy.
+    Returns the matrix, the train/validation/test indices and the fitted StreamingPreprocessor.
+    """
+    preprocessor = StreamingPreprocessor.fit_frame(abalone_dataset)
+    X = np.empty((len(abalone_dataset), 1 + preprocessor.plan().width), dtype=dtype)
+    preprocessor.transform(abalone_dataset, out=X)
+    logger.info(f"Splitting {len(X)} rows of {X.dtype} ({X.nbytes / 1024 ** 2:.1f}MB) by row hash")
+    return X, hash_split_indices(abalone_dataset, split_key), preprocessor
+
+
+# Rows gathered per CSV write of a split given by indices.
+WRITE_CHUNK_ROWS = 100000
+
+
+def write_rows(path, X, indices, chunk_rows=WRITE_CHUNK_ROWS):
+    """Writes the rows indices of X as CSV, gathering chunk_rows at a time so no split is copied whole."""
+    with open(path, "w") as output:
+        for start in range(0, len(indices), chunk_rows):
+            pd.DataFrame(X[indices[start:start + chunk_rows]]).to_csv(output, header=False, index=False)
+
+
+def peak_memory_mb():
+    """Peak resident set size of the process so far, in MB (ru_maxrss is in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+PREPROCESSOR_FILE = "preprocessor.json"
+
+
+def preprocess_abalone_out_of_core(chunks, outputs, include_label=True, split_key=None,
+                                   sketch_capacity=65536):
+    """
+    Streams preprocess_abalone: a first pass over chunks() fits a StreamingPreprocessor, a second one transforms
+    each chunk, assigns its rows by hash to the splits of SPLIT_FRACTIONS and appends them to the CSV files in
+    outputs ({split name: path}, splits without a path are dropped, "raw" receives the untransformed rows).
+    chunks is called once per pass and must give the same DataFrames both times.
+    Rows are ordered by hash within each chunk only, the in-memory paths order the whole split.
+    Returns the fitted StreamingPreprocessor and the number of rows written per output.
+    """
+    preprocessor = StreamingPreprocessor(sketch_capacity=sketch_capacity)
+    for chunk in chunks():
+        preprocessor.partial_fit(chunk)
+    preprocessor.finish()
+    logger.info(f"Fitted the streaming preprocessor on {preprocessor.n_rows} rows")
+
+    counts = {name: 0 for name in outputs}
+    files = {}
+    try:
+        for name, path in outputs.items():
+            pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+            files[name] = open(path, "w")
+        for chunk in chunks():
+            if "raw" in files:
+                chunk.to_csv(files["raw"], header=False, index=False)
+                counts["raw"] += len(chunk)
+            X = preprocessor.transform(chunk)
+            for (name, _), indices in zip(SPLIT_FRACTIONS, hash_split_indices(chunk, split_key)):
+                if name not in files:
+                    continue
+                rows = X[indices]
+                pd.DataFrame(rows if include_label else rows[:, 1:]).to_csv(files[name], header=False, index=False)
+                counts[name] += len(rows)
+    finally:
+        for file in files.values():
+            file.close()
+    logger.info(f"Wrote the streamed splits: {counts}")
+    return preprocessor, counts
+
+# Target size of a single fetched batch; fetchmany sizes are derived from the observed row width.
+FETCH_MEMORY_TARGET_BYTES = 64 * 1024 * 1024
+MIN_FETCH_BATCH_ROWS = 500
+MAX_FETCH_BATCH_ROWS = 1000000
+
+
+def estimate_fetch_batch_size(rows, memory_target_bytes=FETCH_MEMORY_TARGET_BYTES,
+                              min_rows=MIN_FETCH_BATCH_ROWS, max_rows=MAX_FETCH_BATCH_ROWS):
+    """Returns the number of rows per fetchmany call that keeps one batch close to memory_target_bytes.
+
+    The row width is estimated from a sample of the already fetched rows (python tuples).
+    """
+    sample = rows[:100]
+    if not sample:
+        return min_rows
+    sample_bytes = sum(sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row) for row in sample)
+    row_bytes = max(1, sample_bytes // len(sample))
+    return int(min(max_rows, max(min_rows, memory_target_bytes // row_bytes)))
+
+
+def fetch_pandas_batches(cur, sql, memory_target_bytes=FETCH_MEMORY_TARGET_BYTES):
+    """
+    Executes sql and yields the result as a stream of DataFrames, one per fetchmany call.
+    The first batch is MIN_FETCH_BATCH_ROWS rows, following batches adapt to the row width so
+    that a batch stays around memory_target_bytes.
+    """
+    cur.execute(sql)
+    cols = [rmi.name.lower() for rmi in cur.description]
+    batch_size = MIN_FETCH_BATCH_ROWS
+    while True:
+        dat = cur.fetchmany(batch_size)
+        if not dat:
+            break
+        yield pd.DataFrame.from_records(dat, columns=cols)
+        batch_size = estimate_fetch_batch_size(dat, memory_target_bytes)
+
+
+def fetch_pandas_old(cur, sql, memory_target_bytes=FETCH_MEMORY_TARGET_BYTES):
     """
     Putting this adapted method as fetch_pandas_all is failing inside here
     with a silent exit code I have not been able to identify.
     From doc:
         - fetch_pandas_all: https://docs.snowflake.com/en/developer-guide/python-connector/python-connector-api#fetch_pandas_all
         - fetch_pandas_old: https://docs.snowflake.com/developer-guide/python-connector/python-connector-pandas#migrating-to-pandas-dataframes
+    The fetched batches are gathered and concatenated once at the end, instead of growing the dataset
+    batch by batch, which copied the whole table on every fetch.
+    """
+    batches = list(fetch_pandas_batches(cur, sql, memory_target_bytes))
+    if not batches:
+        return pd.DataFrame(columns=[rmi.name.lower() for rmi in cur.description])
+    dataset = pd.concat(batches, ignore_index=True)
+    logger.info(f"Fetched {dataset.shape[0]} rows in {len(batches)} batches")
+    return dataset
+
+# Number of threads downloading result batches or files, override with "fetch_workers" in the bydf parameter.
+FETCH_WORKERS = 8
+
+
+def iter_prefetched(function, items, max_workers=FETCH_WORKERS):
+    """
+    Yields function(item) for every item in order, computing up to max_workers results ahead in a thread pool.
+    Unlike ThreadPoolExecutor.map, at most max_workers results are held in memory at any time.
+    """
+    items = iter(items)
+    max_workers = max(1, max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque(executor.submit(function, item) for _, item in zip(range(max_workers), items))
+        while pending:
+            result = pending.popleft().result()
+            next_item = next(items, None)
+            if next_item is not None:
+                pending.append(executor.submit(function, next_item))
+            yield result
+
+
+def iter_arrow_batches(cur, sql, max_workers=FETCH_WORKERS):
+    """
+    Executes sql and yields pyarrow RecordBatches with lower case column names from the connector's
+    Arrow result batches, which are downloaded concurrently and kept in result order.
+    See https://docs.snowflake.com/en/developer-guide/python-connector/python-connector-distributed-fetch
     """
     cur.execute(sql)
-    cols = []
-    rm = cur.description
-    for rmi in rm:
-        cols.append(rmi.name.lower())
+    cols = [rmi.name.lower() for rmi in cur.description]
+    batches = cur.get_result_batches() or []
+    logger.info(f"Downloading {len(batches)} result batches with {max_workers} workers")
+    for table in iter_prefetched(lambda batch: batch.to_arrow(), batches, max_workers):
+        if table is not None and table.num_rows > 0:
+            for batch in table.rename_columns(cols).to_batches():
+                yield batch
+
+
+def fetch_arrow_batches(cur, sql, max_workers=FETCH_WORKERS):
+    """Same as iter_arrow_batches, gathered in a single pyarrow Table."""
+    batches = list(iter_arrow_batches(cur, sql, max_workers))
+    if not batches:
+        return pa.table({rmi.name.lower(): pa.array([], type=pa.null()) for rmi in cur.description})
+    return pa.Table.from_batches(batches)
+
+
+def fetch_pandas_arrow(cur, sql, max_workers=FETCH_WORKERS):
+    """Same as fetch_arrow_batches, decoded to a typed pandas DataFrame."""
+    return fetch_arrow_batches(cur, sql, max_workers=max_workers).to_pandas()
+
+
+def quote_identifier(name, backend):
+    """Athena (Presto) and DuckDB identifiers are quoted, Snowflake ones are left unquoted so they stay case insensitive."""
+    if name == "*":
+        return name
+    if backend in ("athena", "duckdb"):
+        return '"{}"'.format(name.replace('"', '""'))
+    return name
+
+
+def timestamp_literal(value, backend):
+    """Renders value (any string pandas can parse) as a UTC timestamp literal for the backend."""
+    ts = pd.Timestamp(value)
+    if ts.tzinfo is not None:
+        ts = ts.tz_convert("UTC").tz_localize(None)
+    formatted = ts.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+    if backend in ("athena", "duckdb"):
+        return f"timestamp '{formatted}'"
+    return f"TO_TIMESTAMP_NTZ('{formatted}')"
+
+
+def query_predicates(backend, rings_filter="disabled", time_column=None, window_start=None, window_end=None,
+                     strict_start=False):
+    """
+    Returns the list of SQL predicates pushed down to the source:
+        - the --filter rings threshold, unless it is "disabled"
+        - an optional [window_start, window_end) time window on time_column,
+          (window_start, window_end) with strict_start, as used for watermarks
+    """
+    predicates = []
+    if rings_filter and rings_filter != "disabled":
+        float(rings_filter)  # only numeric thresholds are accepted, raises ValueError otherwise
+        predicates.append(f"{quote_identifier(label_column, backend)} > {rings_filter.strip()}")
+    if time_column and window_start:
+        operator = ">" if strict_start else ">="
+        predicates.append(
+            f"{quote_identifier(time_column, backend)} {operator} {timestamp_literal(window_start, backend)}")
+    if time_column and window_end:
+        predicates.append(f"{quote_identifier(time_column, backend)} < {timestamp_literal(window_end, backend)}")
+    return predicates
+
+
+def build_select_query(backend, table, database=None, columns=None, predicates=()):
+    """
+    Builds the SELECT statement for the backend ("athena", "snowflake" or "duckdb").
+    Only the feature columns and the label are projected unless columns is given.
+    For duckdb, table is the relation to read from, see duckdb_relation.
+    """
+    if columns is None:
+        columns = feature_columns_names + [label_column]
+    projection = ", ".join(quote_identifier(column, backend) for column in columns)
+    if backend == "athena":
+        source = f"{quote_identifier(database, backend)}.{quote_identifier(table, backend)}"
+    else:
+        source = table
+    sql = f"SELECT {projection} FROM {source}"
+    if predicates:
+        sql += " WHERE " + " AND ".join(predicates)
+    return sql + ";"
+
+
+def log_query_savings(dataset, table_rows=None, table_columns=None):
+    """
+    Logs the rows and the estimated bytes that projection and predicate pushdown kept out of the transfer.
+    table_rows and table_columns describe the full source table, the estimate is skipped when they are unknown.
+    """
+    fetched_rows = len(dataset)
+    fetched_bytes = int(dataset.memory_usage(deep=True, index=False).sum())
+    logger.info(f"Fetched {fetched_rows} rows, {len(dataset.columns)} columns, {fetched_bytes} bytes")
+    if table_rows is None or table_columns is None or not len(dataset.columns):
+        return
+    column_bytes = fetched_bytes / max(1, fetched_rows) / len(dataset.columns)
+    full_bytes = int(column_bytes * int(table_rows) * int(table_columns))
+    logger.info(f"Pushdown saved {max(0, int(table_rows) - fetched_rows)} rows "
+                f"and about {max(0, full_bytes - fetched_bytes)} bytes "
+                f"({table_rows} rows x {table_columns} columns in source)")
+
+
+def athena_table_stats(database, table):
+    """Returns (row count, column count) of an Athena table from the Glue catalog, None when unknown."""
+    try:
+        columns = wr.catalog.get_table_types(database=database, table=table) or {}
+        parameters = wr.catalog.get_table_parameters(database=database, table=table) or {}
+        return parameters.get("recordCount"), len(columns) or None
+    except Exception:
+        logger.info(f"Could not read catalog statistics of {database}.{table}")
+        return None, None
+
+
+def snowflake_table_stats(cur, table):
+    """Returns (row count, column count) of a Snowflake table from INFORMATION_SCHEMA, None when unknown."""
+    try:
+        cur.execute("SELECT ROW_COUNT FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = UPPER(%s)", (table,))
+        rows = cur.fetchone()
+        cur.execute("SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = UPPER(%s)", (table,))
+        columns = cur.fetchone()
+        return (rows[0] if rows else None), (columns[0] if columns else None)
+    except Exception:
+        logger.info(f"Could not read INFORMATION_SCHEMA statistics of {table}")
+        return None, None
+
+
+# Rows per DataFrame yielded by the chunked Parquet reads, override with "chunksize" in the bydf parameter.
+PARQUET_CHUNKSIZE = 100000
+
+
+class S3ParquetStore:
+    """Lists and downloads the Parquet files written under an S3 prefix."""
+
+    def list_files(self, prefix):
+        return sorted(path for path in wr.s3.list_objects(prefix)
+                      if not path.rsplit("/", 1)[-1].startswith(("_", ".")))
+
+    def read_table(self, path, columns=None):
+        return pq.read_table(pa.BufferReader(self.read_bytes(path)), columns=columns)
+
+    def exists(self, path):
+        return wr.s3.does_object_exist(path)
+
+    def read_bytes(self, path):
+        buffer = io.BytesIO()
+        wr.s3.download(path=path, local_file=buffer)
+        return buffer.getvalue()
+
+    def write_bytes(self, path, data):
+        wr.s3.upload(local_file=io.BytesIO(data), path=path)
+
+    def delete(self, paths):
+        if paths:
+            wr.s3.delete_objects(list(paths))
+
+
+class LocalParquetStore:
+    """Same interface as S3ParquetStore on a local directory, used for tests and local runs."""
+
+    def list_files(self, prefix):
+        return sorted(str(path) for path in pathlib.Path(prefix).rglob("*")
+                      if path.is_file() and not path.name.startswith(("_", ".")))
+
+    def read_table(self, path, columns=None):
+        return pq.read_table(path, columns=columns)
+
+    def exists(self, path):
+        return pathlib.Path(path).exists()
+
+    def read_bytes(self, path):
+        return pathlib.Path(path).read_bytes()
+
+    def write_bytes(self, path, data):
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        pathlib.Path(path).write_bytes(data)
+
+    def delete(self, paths):
+        for path in paths:
+            if pathlib.Path(path).exists():
+                pathlib.Path(path).unlink()
+
+
+def store_for(path):
+    """Returns the store handling path, S3 for s3:// URIs and the local file system otherwise."""
+    return S3ParquetStore() if str(path).startswith("s3://") else LocalParquetStore()
+
+
+def iter_parquet_batches(store, prefix, chunksize=PARQUET_CHUNKSIZE, max_workers=FETCH_WORKERS, columns=None):
+    """
+    Yields pyarrow RecordBatches of at most chunksize rows from the Parquet files under prefix.
+    Up to max_workers files are downloaded ahead concurrently, so at most that many files are held in memory.
+    """
+    for table in iter_prefetched(lambda path: store.read_table(path, columns), store.list_files(prefix),
+                                 max_workers):
+        for batch in table.to_batches(max_chunksize=chunksize):
+            yield batch
+
+
+def iter_parquet_chunks(store, prefix, chunksize=PARQUET_CHUNKSIZE, max_workers=FETCH_WORKERS,
+                        columns=None):
+    """Same as iter_parquet_batches, as DataFrames."""
+    for batch in iter_parquet_batches(store, prefix, chunksize, max_workers, columns):
+        yield batch.to_pandas()
+
+
+def spill_batches(batches, directory):
+    """Writes a stream of RecordBatches to numbered Parquet files under directory, returns the number of rows."""
+    pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
     rows = 0
-    dataset = pd.DataFrame()
-    while True:
-        dat = cur.fetchmany(500)
-        if not dat:
-            break   
-        df = pd.DataFrame(dat, columns=cols)
-        if dataset.empty:
-            dataset = df
+    for part, batch in enumerate(batches):
+        pq.write_table(pa.Table.from_batches([batch]), f"{directory}/part-{part:05d}.parquet")
+        rows += batch.num_rows
+    return rows
+
+
+def concat_chunks(chunks, columns=None):
+    """Materializes a stream of DataFrames once, an empty stream gives an empty DataFrame with columns."""
+    chunks = list(chunks)
+    if not chunks:
+        return pd.DataFrame(columns=columns if columns is not None else feature_columns_names + [label_column])
+    return pd.concat(chunks, ignore_index=True)
+
+
+def athena_unload_statement(query, s3_output):
+    return f"UNLOAD ({query.rstrip().rstrip(';')}) TO '{s3_output}' WITH (format = 'PARQUET', compression = 'SNAPPY')"
+
+
+def athena_unload(query, database, workgroup, s3_output):
+    """
+    Runs query as an Athena UNLOAD writing Parquet files to s3_output and waits for it to finish.
+    s3_output must be an empty prefix, see https://docs.aws.amazon.com/athena/latest/ug/unload.html
+    """
+    unload = athena_unload_statement(query, s3_output)
+    logger.info(f"Athena unload: {unload}")
+    query_execution_id = wr.athena.start_query_execution(unload, database=database, workgroup=workgroup)
+    wr.athena.wait_query(query_execution_id=query_execution_id)
+    return s3_output
+
+
+INGESTION_STATE_FILE = "state.json"
+
+
+def dataset_schema(dataset):
+    return {column: str(dtype) for column, dtype in dataset.dtypes.items()}
+
+
+def read_ingestion_state(state_dir):
+    """Returns the incremental ingestion state (watermark, time_column, schema, rows) or {} on the first run."""
+    path = pathlib.Path(state_dir) / INGESTION_STATE_FILE
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
+
+
+def reset_ingestion_state(state_dir):
+    shutil.rmtree(state_dir, ignore_errors=True)
+    pathlib.Path(state_dir, "snapshot").mkdir(parents=True, exist_ok=True)
+
+
+def append_ingestion_partition(state_dir, new_rows, time_column):
+    """Stores new_rows as the next snapshot partition and advances the watermark to their latest time_column."""
+    state = read_ingestion_state(state_dir)
+    if new_rows.empty:
+        return state
+    snapshot_dir = pathlib.Path(state_dir, "snapshot")
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+    # unique names so that a reloaded snapshot never reuses the name of an uploaded partition
+    part = len(list(snapshot_dir.glob("part-*.parquet")))
+    new_rows.to_parquet(snapshot_dir / f"part-{part:05d}-{uuid.uuid4().hex[:8]}.parquet", index=False)
+    watermark = pd.Timestamp(new_rows[time_column].max())
+    if state.get("watermark"):
+        watermark = max(watermark, pd.Timestamp(state["watermark"]))
+    state = {
+        "watermark": watermark.isoformat(),
+        "time_column": time_column,
+        "schema": dataset_schema(new_rows),
+        "rows": state.get("rows", 0) + len(new_rows),
+    }
+    pathlib.Path(state_dir, INGESTION_STATE_FILE).write_text(json.dumps(state))
+    return state
+
+
+def fetch_incremental(fetch_since, state_dir, time_column, initial_start=None):
+    """
+    Fetches only the rows newer than the stored watermark and merges them with the local snapshot.
+    fetch_since(window_start, exclusive) returns the rows of the source from window_start on.
+    A different time column or a source schema change drops the snapshot and reloads the full table.
+    """
+    state = read_ingestion_state(state_dir)
+    if state and state.get("time_column") != time_column:
+        logger.info(f"Time column changed to {time_column}, reloading the full table")
+        reset_ingestion_state(state_dir)
+        state = {}
+    if state:
+        logger.info(f"Fetching rows with {time_column} after watermark {state['watermark']}")
+        new_rows = fetch_since(state["watermark"], True)
+        if not new_rows.empty and dataset_schema(new_rows) != state["schema"]:
+            logger.info("Source schema changed, reloading the full table")
+            reset_ingestion_state(state_dir)
+            new_rows = fetch_since(initial_start, False)
+    else:
+        new_rows = fetch_since(initial_start, False)
+    logger.info(f"Fetched {len(new_rows)} new rows")
+    append_ingestion_partition(state_dir, new_rows, time_column)
+    return concat_chunks(iter_parquet_chunks(LocalParquetStore(), pathlib.Path(state_dir, "snapshot")),
+                         columns=list(new_rows.columns))
+
+
+def download_ingestion_state(s3_path, state_dir):
+    reset_ingestion_state(state_dir)
+    for path in wr.s3.list_objects(f"{s3_path}/"):
+        local_path = pathlib.Path(state_dir, path[len(s3_path) + 1:])
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        wr.s3.download(path=path, local_file=str(local_path))
+
+
+def upload_ingestion_state(state_dir, s3_path):
+    """Mirrors state_dir to s3_path, uploading only the new snapshot partitions."""
+    existing = set(wr.s3.list_objects(f"{s3_path}/snapshot/"))
+    local = set()
+    for local_path in sorted(pathlib.Path(state_dir).rglob("*")):
+        path = f"{s3_path}/{local_path.relative_to(state_dir).as_posix()}"
+        if local_path.is_file():
+            local.add(path)
+            if path not in existing:
+                wr.s3.upload(local_file=str(local_path), path=path)
+    if existing - local:
+        wr.s3.delete_objects(sorted(existing - local))
+
+
+def duckdb_relation(path, file_format=None):
+    """
+    Returns the DuckDB table function reading the table files at path, a file, a glob or a directory.
+    The format is inferred from the extension unless file_format ("parquet" or "csv") is given.
+    CSV files are expected without header, in the column order of the abalone dataset.
+    """
+    path = str(path)
+    if not path.startswith("s3://") and pathlib.Path(path).is_dir():
+        path = f"{path.rstrip('/')}/**/*"
+    if file_format is None:
+        file_format = "csv" if path.lower().endswith((".csv", ".csv.gz")) else "parquet"
+    escaped = path.replace("'", "''")
+    if file_format == "csv":
+        names = ", ".join(f"'{column}'" for column in feature_columns_names + [label_column])
+        return f"read_csv_auto('{escaped}', header=false, names=[{names}])"
+    return f"read_parquet('{escaped}')"
+
+
+def duckdb_connection(path):
+    """In-memory DuckDB connection, with httpfs and the boto3 credentials for s3:// paths."""
+    connection = duckdb.connect()
+    if str(path).startswith("s3://"):
+        credentials = boto3.Session().get_credentials().get_frozen_credentials()
+        connection.execute("INSTALL httpfs; LOAD httpfs;")
+        connection.execute("SET s3_region = 'eu-north-1'")
+        connection.execute(f"SET s3_access_key_id = '{credentials.access_key}'")
+        connection.execute(f"SET s3_secret_access_key = '{credentials.secret_key}'")
+        if credentials.token:
+            connection.execute(f"SET s3_session_token = '{credentials.token}'")
+    return connection
+
+
+def fetch_duckdb_arrow(query, connection=None):
+    """Runs query on the embedded DuckDB engine and returns a pyarrow Table."""
+    connection = connection or duckdb.connect()
+    result = connection.execute(query).arrow()
+    # newer DuckDB versions return a RecordBatchReader
+    return result.read_all() if hasattr(result, "read_all") else result
+
+
+def iter_duckdb_batches(query, connection=None, chunksize=PARQUET_CHUNKSIZE):
+    """Runs query on the embedded DuckDB engine and yields pyarrow RecordBatches of at most chunksize rows."""
+    connection = connection or duckdb.connect()
+    result = connection.execute(query)
+    reader = result.to_arrow_reader(chunksize) if hasattr(result, "to_arrow_reader") \
+        else result.fetch_record_batch(chunksize)
+    for batch in reader:
+        yield batch
+
+
+def local_source_version(path):
+    """Version token of local table files: name, size and modification time of every file."""
+    root = pathlib.Path(path)
+    files = sorted(root.rglob("*")) if root.is_dir() else sorted(root.parent.glob(root.name))
+    return hashlib.sha256("".join(
+        f"{file}:{file.stat().st_size}:{file.stat().st_mtime_ns};" for file in files if file.is_file()
+    ).encode("utf-8")).hexdigest()
+
+
+def normalize_sql(sql):
+    """Collapses whitespace outside of string literals and drops the trailing semicolon."""
+    parts = re.split(r"('(?:[^']|'')*')", sql.strip().rstrip(";").strip())
+    return "".join(part if part.startswith("'") else re.sub(r"\s+", " ", part) for part in parts)
+
+
+class QueryResultCache:
+    """
+    Content addressed cache of query results, stored as Parquet under root (local directory or s3:// prefix).
+    Entries are keyed by the normalized SQL and a version token of the source table, expire after ttl_seconds
+    and the least recently used ones are evicted once the cache grows over max_bytes.
+    """
+    INDEX_FILE = "index.json"
+
+    def __init__(self, root, ttl_seconds=8 * 3600, max_bytes=5 * 1024 ** 3, store=None):
+        self.root = str(root).rstrip("/")
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.store = store or store_for(self.root)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(sql, source_version):
+        return hashlib.sha256(f"{normalize_sql(sql)}\n{source_version}".encode("utf-8")).hexdigest()
+
+    def _path(self, name):
+        return f"{self.root}/{name}"
+
+    def _read_index(self):
+        if not self.store.exists(self._path(self.INDEX_FILE)):
+            return {}
+        return json.loads(self.store.read_bytes(self._path(self.INDEX_FILE)))
+
+    def _write_index(self, index):
+        self.store.write_bytes(self._path(self.INDEX_FILE), json.dumps(index).encode("utf-8"))
+
+    def get(self, sql, source_version):
+        """Returns the cached DataFrame of sql at source_version, None on a miss."""
+        key = self.key(sql, source_version)
+        index = self._read_index()
+        entry = index.get(key)
+        now = time.time()
+        if entry is None or now - entry["created"] > self.ttl_seconds:
+            self.misses += 1
+            logger.info(f"Query cache miss {key[:12]} (hits {self.hits}, misses {self.misses})")
+            return None
+        dataset = self.store.read_table(self._path(f"{key}.parquet")).to_pandas()
+        entry["last_access"] = now
+        self._write_index(index)
+        self.hits += 1
+        logger.info(f"Query cache hit {key[:12]} (hits {self.hits}, misses {self.misses})")
+        return dataset
+
+    def put(self, sql, source_version, dataset):
+        key = self.key(sql, source_version)
+        buffer = io.BytesIO()
+        dataset.to_parquet(buffer, index=False)
+        self.store.write_bytes(self._path(f"{key}.parquet"), buffer.getvalue())
+        now = time.time()
+        index = self._read_index()
+        index[key] = {"created": now, "last_access": now, "bytes": buffer.tell(), "sql": normalize_sql(sql),
+                      "source_version": str(source_version)}
+        self._write_index(self._evict(index, now))
+
+    def _evict(self, index, now):
+        """Drops expired entries, then the least recently used ones until the cache fits in max_bytes."""
+        evicted = [key for key, entry in index.items() if now - entry["created"] > self.ttl_seconds]
+        live = sorted((entry["last_access"], key) for key, entry in index.items() if key not in evicted)
+        total = sum(index[key]["bytes"] for _, key in live)
+        while live and total > self.max_bytes:
+            _, key = live.pop(0)
+            total -= index[key]["bytes"]
+            evicted.append(key)
+        if evicted:
+            logger.info(f"Query cache evicting {len(evicted)} entries")
+            self.store.delete([self._path(f"{key}.parquet") for key in evicted])
+        return {key: entry for key, entry in index.items() if key not in evicted}
+
+    def metrics(self, pipeline_name):
+        """Hit and miss counts in the metric format of monitoring/postprocess_monitor_script.py"""
+        return [
+            {"metric_name": "query_cache_hits", "metric_value": float(self.hits), "pipeline_name": pipeline_name},
+            {"metric_name": "query_cache_misses", "metric_value": float(self.misses), "pipeline_name": pipeline_name},
+        ]
+
+
+def put_cloudwatch_metric(metrics, namespace="aws/Sagemaker/ModelBuildingPipeline/data-metrics"):
+    cw = boto3.client('cloudwatch', region_name='eu-north-1')
+    metric_data = [
+        {
+            "MetricName": m["metric_name"],
+            "Dimensions": [{"Name": "PipelineName", "Value": m["pipeline_name"]}],
+            "Timestamp": datetime.utcnow(),
+            "Value": m["metric_value"],
+            "Unit": "None",
+        }
+        for m in metrics
+    ]
+    logger.info(f"Publishing metric data to Cloudwatch metrics @ namespace {namespace}: {metric_data}")
+    cw.put_metric_data(Namespace=namespace, MetricData=metric_data)
+
+
+def athena_source_version(database, table):
+    """Version token of an Athena table, see s3_source_version."""
+    return s3_source_version(wr.catalog.get_table_location(database=database, table=table))
+
+
+def s3_source_version(location):
+    """Version token of the files under an S3 location: object count, total size and latest modification."""
+    bucket, _, prefix = location[len("s3://"):].partition("/")
+    count, size, last_modified = 0, 0, ""
+    paginator = boto3.client('s3', region_name='eu-north-1').get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            count += 1
+            size += obj["Size"]
+            last_modified = max(last_modified, obj["LastModified"].isoformat())
+    return f"{location}:{count}:{size}:{last_modified}"
+
+
+def snowflake_source_version(cur, table):
+    """Version token of a Snowflake table: LAST_ALTERED changes on every DML and DDL statement."""
+    cur.execute("SELECT LAST_ALTERED, ROW_COUNT, BYTES FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = UPPER(%s)",
+                (table,))
+    return ":".join(str(value) for value in (cur.fetchone() or ()))
+
+
+# pyarrow type aliases, see pyarrow.type_for_alias
+ATHENA_ARROW_TYPES = {
+    "boolean": "bool", "tinyint": "int8", "smallint": "int16", "int": "int32", "integer": "int32",
+    "bigint": "int64", "float": "float32", "real": "float32", "double": "float64",
+    "date": "date32", "timestamp": "timestamp[ns]",
+}
+SNOWFLAKE_ARROW_TYPES = {
+    "REAL": "float64", "TEXT": "string", "BOOLEAN": "bool", "DATE": "date32",
+    "TIMESTAMP_NTZ": "timestamp[ns]", "TIMESTAMP_LTZ": "timestamp[ns]", "TIMESTAMP_TZ": "timestamp[ns]",
+}
+
+# fetch_data_from name -> DataSource class, see register_data_source
+DATA_SOURCES = {}
+
+
+def register_data_source(*names):
+    """Class decorator registering a DataSource under the fetch_data_from names of the bydf parameter."""
+    def register(cls):
+        for name in names:
+            DATA_SOURCES[name] = cls
+        return cls
+    return register
+
+
+def create_data_source(config, **kwargs):
+    """Instantiates the DataSource selected by "fetch_data_from" (default athena) in the bydf parameter."""
+    name = config.get("fetch_data_from", "athena")
+    if name not in DATA_SOURCES:
+        raise ValueError(f"Unsupported fetch_data_from {name}, registered: {sorted(DATA_SOURCES)}")
+    return DATA_SOURCES[name](config, **kwargs)
+
+
+class DataSource:
+    """
+    Source of the abalone rows. Subclasses set the SQL dialect in backend and implement iter_batches,
+    the estimates return None when the source cannot tell cheaply.
+        - iter_batches: stream of typed pyarrow RecordBatches of the projected and filtered rows
+        - estimate_rows: row count of the whole source
+        - schema: pyarrow Schema of the projected columns (all columns when columns is None)
+        - version: token changing whenever the source data changes, used by QueryResultCache
+    """
+    backend = None
+
+    def __init__(self, config, database=None, table=None, env_type=None, run_prefix=""):
+        self.config = config
+        self.database = database
+        self.table = table
+        self.env_type = env_type
+        self.run_prefix = run_prefix
+        self.chunksize = int(config.get("chunksize", PARQUET_CHUNKSIZE))
+        self.max_workers = int(config.get("fetch_workers", FETCH_WORKERS))
+
+    def relation(self):
+        return self.table
+
+    def query(self, columns=None, predicates=()):
+        return build_select_query(self.backend, self.relation(), database=self.database, columns=columns,
+                                  predicates=predicates)
+
+    def submit(self, columns=None, predicates=(), client=None):
+        """
+        Starts the query ahead of iter_batches where the source supports it, a no-op by default.
+        client is a pre-created boto3 client for the sources submitting through one.
+        """
+        return None
+
+    def iter_batches(self, columns=None, predicates=()):
+        raise NotImplementedError
+
+    def estimate_rows(self):
+        return None
+
+    def schema(self, columns=None):
+        return None
+
+    def version(self):
+        return None
+
+    def read(self, columns=None, predicates=()):
+        """Materializes iter_batches once as a DataFrame."""
+        return concat_chunks((batch.to_pandas() for batch in self.iter_batches(columns, predicates)),
+                             columns=columns)
+
+
+@register_data_source("athena")
+class AthenaDataSource(DataSource):
+    """
+    Athena table, read through the query result API or, with "athena_read": "unload", as Parquet files.
+    submit starts the query with boto3 alone, so it runs while the runtime packages are being installed.
+    """
+    backend = "athena"
+
+    def __init__(self, config, **kwargs):
+        super().__init__(config, **kwargs)
+        self._submitted = {}
+
+    def workgroup(self):
+        return f"{self.env_type}-athena-workgroup"
+
+    def unload_path(self):
+        unload_path = self.config.get("athena_unload_path", f"s3://{data_bucket_name(self.env_type)}/athena-unload")
+        # UNLOAD needs an empty prefix, a fetch can run more than once per execution (incremental reloads)
+        return f"{unload_path.rstrip('/')}/{self.run_prefix}/{uuid.uuid4().hex[:8]}/"
+
+    def submit(self, columns=None, predicates=(), client=None):
+        query = self.query(columns, predicates)
+        unload_path = self.unload_path() if self.config.get("athena_read", "api") == "unload" else None
+        statement = athena_unload_statement(query, unload_path) if unload_path else query
+        if client is None:
+            client = boto3.client('athena', region_name='eu-north-1')
+        query_execution_id = client.start_query_execution(
+            QueryString=statement,
+            QueryExecutionContext={"Database": self.database},
+            WorkGroup=self.workgroup(),
+        )["QueryExecutionId"]
+        logger.info(f"Athena query submitted ahead of the read: {query_execution_id}")
+        self._submitted[query] = (query_execution_id, unload_path)
+        return query_execution_id
+
+    def iter_batches(self, columns=None, predicates=()):
+        query = self.query(columns, predicates)
+        logger.info(f"Athena query: {query}")
+        if query in self._submitted:
+            query_execution_id, unload_path = self._submitted.pop(query)
+            wr.athena.wait_query(query_execution_id=query_execution_id)
+            if unload_path:
+                for batch in iter_parquet_batches(S3ParquetStore(), unload_path, chunksize=self.chunksize,
+                                                  max_workers=self.max_workers):
+                    yield batch
+            else:
+                for chunk in wr.athena.get_query_results(query_execution_id, chunksize=self.chunksize):
+                    yield pa.RecordBatch.from_pandas(chunk, preserve_index=False)
+            return
+        workgroup = self.workgroup()
+        if self.config.get("athena_read", "api") == "unload":
+            unload_path = self.unload_path()
+            athena_unload(query, database=self.database, workgroup=workgroup, s3_output=unload_path)
+            for batch in iter_parquet_batches(S3ParquetStore(), unload_path, chunksize=self.chunksize,
+                                              max_workers=self.max_workers):
+                yield batch
+        else:
+            for chunk in wr.athena.read_sql_query(query, database=self.database, workgroup=workgroup,
+                                                  ctas_approach=False, chunksize=self.chunksize):
+                yield pa.RecordBatch.from_pandas(chunk, preserve_index=False)
+
+    def estimate_rows(self):
+        return athena_table_stats(self.database, self.table)[0]
+
+    def schema(self, columns=None):
+        try:
+            types = wr.catalog.get_table_types(database=self.database, table=self.table) or {}
+        except Exception:
+            return None
+        return pa.schema([(name, pa.type_for_alias(ATHENA_ARROW_TYPES.get(athena_type.split("(")[0], "string")))
+                          for name, athena_type in types.items() if columns is None or name in columns])
+
+    def version(self):
+        return athena_source_version(self.database, self.table)
+
+
+@register_data_source("snowflake")
+class SnowflakeDataSource(DataSource):
+    """
+    Snowflake table, "connection_parameters" in the bydf parameter are passed to snowflake.connector.connect.
+    Result batches are downloaded as Arrow in parallel unless "snowflake_fetch" is "cursor".
+    """
+    backend = "snowflake"
+
+    def __init__(self, config, **kwargs):
+        super().__init__(config, **kwargs)
+        self._connection = None
+
+    def cursor(self):
+        if self._connection is None:
+            self._connection = snowflake.connector.connect(**self.config['connection_parameters'])
+        return self._connection.cursor()
+
+    def iter_batches(self, columns=None, predicates=()):
+        query = self.query(columns, predicates)
+        logger.info(f"Snowflake query: {query}")
+        if self.config.get("snowflake_fetch", "arrow") == "arrow":
+            for batch in iter_arrow_batches(self.cursor(), query, max_workers=self.max_workers):
+                yield batch
         else:
-            dataset = pd.concat([dataset, df], ignore_index=True)
-        rows += df.shape[0]
+            for chunk in fetch_pandas_batches(self.cursor(), query):
+                yield pa.RecordBatch.from_pandas(chunk, preserve_index=False)
+
+    def estimate_rows(self):
+        return snowflake_table_stats(self.cursor(), self.table)[0]
+
+    def schema(self, columns=None):
+        fields = []
+        for column in self.cursor().describe(self.query(columns if columns is not None else ["*"])):
+            type_name = FIELD_ID_TO_NAME[column.type_code]
+            if type_name == "FIXED":
+                arrow_type = "int64" if not column.scale else "float64"
+            else:
+                arrow_type = SNOWFLAKE_ARROW_TYPES.get(type_name, "string")
+            fields.append((column.name.lower(), pa.type_for_alias(arrow_type)))
+        return pa.schema(fields)
+
+    def version(self):
+        return snowflake_source_version(self.cursor(), self.table)
+
+
+@register_data_source("duckdb", "local")
+class LocalFileDataSource(DataSource):
+    """
+    Parquet or CSV table files read by the embedded DuckDB engine, from "duckdb_path" (file, glob or
+    directory, local or s3://) or else the table's Glue location.
+    """
+    backend = "duckdb"
+
+    def path(self):
+        return self.config.get("duckdb_path") or wr.catalog.get_table_location(database=self.database,
+                                                                                table=self.table)
+
+    def relation(self):
+        return duckdb_relation(self.path(), self.config.get("duckdb_format"))
+
+    def connection(self):
+        return duckdb_connection(self.path())
+
+    def iter_batches(self, columns=None, predicates=()):
+        query = self.query(columns, predicates)
+        logger.info(f"DuckDB query: {query}")
+        for batch in iter_duckdb_batches(query, self.connection(), chunksize=self.chunksize):
+            yield batch
+
+    def estimate_rows(self):
+        return fetch_duckdb_arrow(f"SELECT COUNT(*) AS n FROM {self.relation()}", self.connection()) \
+            .column("n")[0].as_py()
+
+    def schema(self, columns=None):
+        query = self.query(columns if columns is not None else ["*"]).rstrip(";")
+        return fetch_duckdb_arrow(f"{query} LIMIT 0", self.connection()).schema
+
+    def version(self):
+        path = self.path()
+        return s3_source_version(path) if path.startswith("s3://") else local_source_version(path)
+
+
+@register_data_source("memory")
+class InMemoryDataSource(LocalFileDataSource):
+    """A DataFrame or pyarrow Table held in memory, queried with DuckDB. Stand-in source for tests and local runs."""
+
+    def __init__(self, config, data=None, **kwargs):
+        super().__init__(config, **kwargs)
+        data = config.get("data") if data is None else data
+        self.data = pa.Table.from_pandas(data, preserve_index=False) if isinstance(data, pd.DataFrame) else data
+
+    def relation(self):
+        return "source"
+
+    def connection(self):
+        connection = duckdb.connect()
+        connection.register("source", self.data)
+        return connection
+
+    def estimate_rows(self):
+        return self.data.num_rows
+
+    def version(self):
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, self.data.schema) as writer:
+            writer.write_table(self.data)
+        return hashlib.sha256(sink.getvalue().to_pybytes()).hexdigest()
+
+
+def fetch_dataset(source, predicates=(), columns=None, cache=None):
+    """
+    Reads the projected and filtered rows of a DataSource into a DataFrame.
+    With a QueryResultCache, a result cached for the same query and source version is returned instead.
+    """
+    query = source.query(columns, predicates)
+    if cache is not None:
+        source_version = source.version()
+        dataset = cache.get(query, source_version)
+        if dataset is not None:
+            return dataset
+    dataset = source.read(columns, predicates)
+    try:
+        full_schema = source.schema()
+        log_query_savings(dataset, source.estimate_rows(), len(full_schema) if full_schema is not None else None)
+    except Exception:
+        logger.info("Could not estimate the size of the source")
+    if cache is not None:
+        cache.put(query, source_version, dataset)
     return dataset
 
+
+def data_bucket_name(env_type):
+    ssm = boto3.client('ssm', region_name='eu-north-1')
+    return ssm.get_parameter(Name=f"mlops-{env_type}-data-bucket-name")['Parameter']['Value']
+
+
 def exist_ssm_param(param_name: str) -> bool:
     ssm = boto3.client('ssm', region_name='eu-north-1')
 
@@ -148,6 +1382,18 @@ def exist_ssm_param(param_name: str) -> bool:
         pass
     return False
 
+
+def load_bydf(ssm, param_name):
+    """Reads the bring-your-own-data-foundation json parameter, {} when it is not set."""
+    if param_name:
+        try:
+            return json.loads(ssm.get_parameter(Name=param_name)['Parameter']['Value'])
+        except ssm.exceptions.ParameterNotFound:
+            pass
+    logger.info(f"bydf_param_name {param_name} cannot be found")
+    return {}
+
+
 if __name__ == "__main__":
 
     logging.getLogger('snowflake.connector').setLevel(logging.DEBUG)
@@ -160,6 +1406,7 @@ if __name__ == "__main__":
     pathlib.Path(f"{base_dir}/validation").mkdir(parents=True, exist_ok=True)
     pathlib.Path(f"{base_dir}/inference-test").mkdir(parents=True, exist_ok=True)
     pathlib.Path(f"{base_dir}/raw").mkdir(parents=True, exist_ok=True)
+    pathlib.Path(f"{base_dir}/preprocessor").mkdir(parents=True, exist_ok=True)
     #abalone_dataset = f"{base_dir}/input/athena-input.parquet"
 
     parser = argparse.ArgumentParser()
@@ -192,50 +1439,145 @@ if __name__ == "__main__":
     #logger.info(f"training_job_name:{args.training_job_name}")
     #logger.info(f"processing_job_name:{args.processing_job_name}")
     boto3.setup_default_session(region_name="eu-north-1")
+    # clients are created up front, creating them is not thread safe while calling them is
     ssm = boto3.client('ssm', region_name="eu-north-1")
-    env_type=ssm.get_parameter(Name='EnvType')['Parameter']['Value']
+    athena = boto3.client('athena', region_name="eu-north-1")
+    codeartifact = boto3.client('codeartifact', config=Config(region_name='eu-north-1', signature_version='v4',
+                                                              retries={'max_attempts': 10, 'mode': 'standard'}))
 
-    if args.filter == "disabled":
-        query_filter = ""
-    else:
-        query_filter = f'WHERE rings > {args.filter}'
+    def install_packages(env_type, bydf):
+        wheelhouse = bydf.get("wheelhouse_path", f"s3://{data_bucket_name(env_type)}/wheelhouse")
+        timings = ensure_requirements(RUNTIME_PACKAGES, wheelhouse=wheelhouse,
+                                      authenticate=lambda: auth_codeartifact(client=codeartifact))
+        import_runtime_packages()
+        return timings
 
-    if args.bydf_param_name and exist_ssm_param(param_name=args.bydf_param_name):
-        bydf = json.loads(ssm.get_parameter(Name=args.bydf_param_name)['Parameter']['Value'])
-    else:
-        logger.info(f"bydf_param_name {args.bydf_param_name} cannot be found")
-        bydf = {}
-    fetch_data_from = bydf.get("fetch_data_from", "athena")
-
-    if fetch_data_from == "athena":
-        abalone_dataset = wr.athena.read_sql_query(
-            f'SELECT * FROM "{args.database}"."{args.table}" {query_filter};',
-            database=args.database,
-            workgroup= f"{env_type}-athena-workgroup",
-            ctas_approach="False"
+    def create_source(env_type, bydf):
+        source = create_data_source(bydf, database=args.database, table=args.table, env_type=env_type,
+                                    run_prefix=f"{args.pipeline_name}/{args.pipeline_execution_id}/{args.context}")
+        predicates = query_predicates(
+            backend=source.backend,
+            rings_filter=args.filter,
+            time_column=bydf.get("time_column"),
+            window_start=bydf.get("time_window_start"),
+            window_end=bydf.get("time_window_end"),
         )
-    if fetch_data_from == "snowflake":
-        ctx = snowflake.connector.connect(**bydf['connection_parameters'])
-        query = f"""SELECT * FROM {args.table} {query_filter};"""
-        cur = ctx.cursor()
-        abalone_dataset = fetch_pandas_old(cur=cur, sql=query)
+        # a cached or incremental read decides what to query only once the packages are there
+        if not bydf.get("query_cache_path") and bydf.get("ingestion") != "incremental":
+            source.submit(predicates=predicates, client=athena)
+        return source, predicates
+
+    def load_dataset(packages, env_type, bydf, source):
+        source, predicates = source
+        query_cache = None
+        if bydf.get("query_cache_path"):
+            query_cache = QueryResultCache(
+                bydf["query_cache_path"],
+                ttl_seconds=int(bydf.get("query_cache_ttl_seconds", 8 * 3600)),
+                max_bytes=int(bydf.get("query_cache_max_bytes", 5 * 1024 ** 3)),
+            )
 
-    if args.context == "training":
+        if bydf.get("ingestion") == "incremental" and bydf.get("time_column"):
+            time_column = bydf["time_column"]
+            state_path = bydf.get("incremental_state_path", f"s3://{data_bucket_name(env_type)}/incremental-state")
+            state_path = f"{state_path.rstrip('/')}/{args.pipeline_name}/{args.context}/{args.table}"
+            state_dir = f"{base_dir}/incremental-state"
+            download_ingestion_state(state_path, state_dir)
 
+            def fetch_since(watermark, exclusive):
+                return fetch_dataset(source, columns=feature_columns_names + [label_column, time_column],
+                                     predicates=query_predicates(
+                                         backend=source.backend,
+                                         rings_filter=args.filter,
+                                         time_column=time_column,
+                                         window_start=watermark,
+                                         window_end=bydf.get("time_window_end"),
+                                         strict_start=exclusive,
+                                     ), cache=query_cache)
+
+            dataset = fetch_incremental(fetch_since, state_dir, time_column,
+                                        initial_start=bydf.get("time_window_start"))
+            upload_ingestion_state(state_dir, state_path)
+        elif bydf.get("preprocess") == "out_of_core" and query_cache is None:
+            # handed to the streaming preprocessing as Parquet files, never held in memory as a whole
+            dataset = f"{base_dir}/spill"
+            rows = spill_batches(source.iter_batches(predicates=predicates), dataset)
+            logger.info(f"Spilled {rows} rows to {dataset}")
+        else:
+            dataset = fetch_dataset(source, predicates=predicates, cache=query_cache)
+        if query_cache is not None:
+            try:
+                put_cloudwatch_metric(query_cache.metrics(args.pipeline_name))
+            except Exception:
+                logger.info("Could not publish the query cache metrics")
+        return dataset
+
+    bootstrap = Bootstrap()
+    bootstrap.add("env_type", lambda: ssm.get_parameter(Name='EnvType')['Parameter']['Value'])
+    bootstrap.add("bydf", lambda: load_bydf(ssm, args.bydf_param_name))
+    bootstrap.add("packages", install_packages, depends_on=["env_type", "bydf"])
+    bootstrap.add("source", create_source, depends_on=["env_type", "bydf"])
+    bootstrap.add("dataset", load_dataset, depends_on=["packages", "env_type", "bydf", "source"])
+    results = bootstrap.run()
+    bootstrap.log_timings()
+    env_type, bydf, abalone_dataset = results["env_type"], results["bydf"], results["dataset"]
+
+    chunksize = int(bydf.get("chunksize", PARQUET_CHUNKSIZE))
+    if isinstance(abalone_dataset, pd.DataFrame):
+        chunks = lambda: (abalone_dataset[start:start + chunksize]
+                          for start in range(0, len(abalone_dataset), chunksize))
+    else:
+        chunks = lambda: iter_parquet_chunks(LocalParquetStore(), abalone_dataset, chunksize=chunksize)
+    # saved by the training next to the model, registered in the model package metadata as "preprocessor"
+    preprocessor_path = f"{base_dir}/preprocessor/{PREPROCESSOR_FILE}"
+    training_preprocessor_path = f"{base_dir}/input/preprocessor/{PREPROCESSOR_FILE}"
+
+    if args.context == "training" and bydf.get("preprocess") == "lean":
         pd.DataFrame(abalone_dataset).to_csv(f"{base_dir}/raw/raw.csv", header=False, index=False)
-        train, validation, test = preprocess_abalone(abalone_dataset)
+        X, (train, validation, test), preprocessor = preprocess_abalone_lean(abalone_dataset,
+                                                                             split_key=bydf.get("split_key"))
+        preprocessor.save(preprocessor_path)
+        logger.info("Writing out datasets to %s.", base_dir)
+        write_rows(f"{base_dir}/train/train.csv", X, train)
+        write_rows(f"{base_dir}/validation/validation.csv", X, validation)
+        write_rows(f"{base_dir}/test/test.csv", X, test)
+    elif args.context == "training" and bydf.get("preprocess") == "out_of_core":
+        preprocessor, _ = preprocess_abalone_out_of_core(chunks, {
+            "raw": f"{base_dir}/raw/raw.csv",
+            "train": f"{base_dir}/train/train.csv",
+            "validation": f"{base_dir}/validation/validation.csv",
+            "test": f"{base_dir}/test/test.csv",
+        }, split_key=bydf.get("split_key"))
+        preprocessor.save(preprocessor_path)
+    elif args.context == "training":
+
+        pd.DataFrame(abalone_dataset).to_csv(f"{base_dir}/raw/raw.csv", header=False, index=False)
+        (train, validation, test), preprocessor = preprocess_abalone(abalone_dataset, return_preprocessor=True,
+                                                                     split_key=bydf.get("split_key"))
+        preprocessor.save(preprocessor_path)
         logger.info("Writing out datasets to %s.", base_dir)
         pd.DataFrame(train).to_csv(f"{base_dir}/train/train.csv", header=False, index=False)
         pd.DataFrame(validation).to_csv(
             f"{base_dir}/validation/validation.csv", header=False, index=False
         )
         pd.DataFrame(test).to_csv(f"{base_dir}/test/test.csv", header=False, index=False)
+    elif args.context == "inference" and pathlib.Path(training_preprocessor_path).exists():
+        print(f"execution time (UTC): {args.executiontime}")
+        transform_abalone(chunks(), StreamingPreprocessor.load(training_preprocessor_path),
+                          f"{base_dir}/inference-test/inference-data.csv")
+    elif args.context == "inference" and bydf.get("preprocess") == "out_of_core":
+        logger.info(f"No training preprocessor at {training_preprocessor_path}, fitting on the inference data")
+        preprocess_abalone_out_of_core(chunks, {
+            "raw": f"{base_dir}/raw/raw.csv",
+            "test": f"{base_dir}/inference-test/inference-data.csv",
+        }, include_label=False, split_key=bydf.get("split_key"))
     elif args.context == "inference":
+        logger.info(f"No training preprocessor at {training_preprocessor_path}, fitting on the inference data")
         print("Some mock processing for now")
         
         print(f"execution time (UTC): {args.executiontime}")
 
-        train, validation, test = preprocess_abalone(abalone_dataset)
+        train, validation, test = preprocess_abalone(abalone_dataset, split_key=bydf.get("split_key"))
         test_df = pd.DataFrame(test)
         first_column = test_df.columns[0]
         inference_data = test_df.drop([first_column], axis=1)
@@ -244,6 +1586,7 @@ if __name__ == "__main__":
     else:
         logger.info("missing context, allowed values are training or inference")
         sys.exit("missing supported context type")
+    logger.info(f"Preprocess peak memory: {peak_memory_mb():.0f}MB")
 
 
 
@@ -0,0 +1,97 @@
+import pytest
+
+
+def test_missing_requirements_checks_pinned_versions():
+    import pandas
+    from source_scripts.bootstrap.bootstrap import missing_requirements, requirement_name
+    assert requirement_name("snowflake-connector-python==3.0.3") == ("snowflake-connector-python", "3.0.3")
+    assert requirement_name("awswrangler") == ("awswrangler", None)
+    assert missing_requirements(["pandas", f"pandas=={pandas.__version__}"]) == []
+    assert missing_requirements(["pandas==0.0.1", "surely-not-installed-package"]) == \
+        ["pandas==0.0.1", "surely-not-installed-package"]
+
+
+def test_requirements_hash_ignores_order_and_case():
+    from source_scripts.bootstrap.bootstrap import requirements_hash
+    assert requirements_hash(["duckdb", "SQLAlchemy==1.4.47"]) == requirements_hash(["sqlalchemy==1.4.47", "duckdb"])
+    assert requirements_hash(["duckdb"]) != requirements_hash(["duckdb", "awswrangler"])
+
+
+def test_ensure_requirements_skips_installed_packages(monkeypatch):
+    from source_scripts.bootstrap import bootstrap
+    monkeypatch.setattr(bootstrap, "pip", fail_pip)
+    timings = bootstrap.ensure_requirements(["pandas", "numpy"], authenticate=fail_pip)
+    assert timings["source"] == "installed"
+
+
+def test_ensure_requirements_builds_then_reuses_the_wheelhouse(monkeypatch, tmp_path):
+    from source_scripts.bootstrap import bootstrap
+    calls = []
+
+    def fake_pip(*arguments):
+        calls.append(arguments)
+        if arguments[0] == "wheel":
+            wheel_dir = arguments[arguments.index("--wheel-dir") + 1]
+            open(f"{wheel_dir}/surely_not_installed_package-1.0-py3-none-any.whl", "w").close()
+
+    monkeypatch.setattr(bootstrap, "pip", fake_pip)
+    authenticated = []
+    wheelhouse = str(tmp_path / "wheelhouse")
+    first = bootstrap.ensure_requirements(["pandas", "surely-not-installed-package"], wheelhouse=wheelhouse,
+                                          authenticate=lambda: authenticated.append(True))
+    assert first["source"] == "index"
+    assert authenticated == [True]
+    assert [call[0] for call in calls] == ["wheel", "install"]
+    assert calls[0][-1] == "surely-not-installed-package"
+
+    calls.clear()
+    second = bootstrap.ensure_requirements(["surely-not-installed-package", "pandas"], wheelhouse=wheelhouse,
+                                           authenticate=fail_pip)
+    assert second["source"] == "wheelhouse"
+    assert [call[:2] for call in calls] == [("install", "--no-index")]
+
+
+def test_bootstrap_runs_independent_tasks_concurrently():
+    import time
+    from source_scripts.bootstrap.bootstrap import Bootstrap
+
+    def slow(value):
+        def task(**dependencies):
+            time.sleep(0.2)
+            return value, dependencies
+        return task
+
+    bootstrap = Bootstrap()
+    bootstrap.add("auth", slow("auth"))
+    bootstrap.add("packages", slow("packages"), depends_on=["auth"])
+    bootstrap.add("ssm", slow("ssm"))
+    bootstrap.add("query", slow("query"), depends_on=["ssm"])
+    results = bootstrap.run()
+    assert results["query"] == ("query", {"ssm": ("ssm", {})})
+    assert bootstrap.timings["query"][0] >= bootstrap.timings["ssm"][1]
+    summary = bootstrap.summary()
+    # two chains of two 0.2s tasks: ~0.4s wall clock for 0.8s of work
+    assert summary["wall_seconds"] < 0.7
+    assert summary["overlap_seconds"] > 0.2
+
+
+def test_bootstrap_dependency_errors():
+    import pytest
+    from source_scripts.bootstrap.bootstrap import Bootstrap
+
+    def fail():
+        raise RuntimeError("codeartifact unreachable")
+
+    bootstrap = Bootstrap()
+    with pytest.raises(ValueError):
+        bootstrap.add("packages", lambda auth: None, depends_on=["auth"])
+    bootstrap.add("auth", fail)
+    bootstrap.add("packages", lambda auth: "installed", depends_on=["auth"])
+    bootstrap.add("ssm", lambda: "dev")
+    with pytest.raises(RuntimeError, match="codeartifact unreachable"):
+        bootstrap.run()
+    assert set(bootstrap.timings) == {"auth", "ssm"}
+
+
+def fail_pip(*arguments):
+    raise AssertionError(f"pip should not run: {arguments}")
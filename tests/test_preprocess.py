@@ -115,6 +115,468 @@ def test_preprocess():
     pd.DataFrame(test).to_csv("../temp/test.csv", header=False, index=False)
 
 
+def test_fetch_pandas_old_gathers_batches():
+    from source_scripts.preprocessing.preprocess import fetch_pandas_old
+    cursor = FakeCursor(n_rows=1234)
+    dataset = fetch_pandas_old(cursor, "SELECT * FROM abalone")
+    assert list(dataset.columns) == ["sex", "length", "rings"]
+    assert len(dataset) == 1234
+    assert dataset["rings"].tolist() == list(range(1234))
+    # first batch is fixed, the following ones are sized from the row width
+    assert cursor.requested[0] == 500
+    assert cursor.requested[1] > 500
+
+
+def test_fetch_pandas_old_empty_result_keeps_columns():
+    from source_scripts.preprocessing.preprocess import fetch_pandas_old
+    dataset = fetch_pandas_old(FakeCursor(n_rows=0), "SELECT * FROM abalone")
+    assert dataset.empty
+    assert list(dataset.columns) == ["sex", "length", "rings"]
+
+
+def test_estimate_fetch_batch_size_bounds():
+    from source_scripts.preprocessing.preprocess import estimate_fetch_batch_size
+    narrow = [("M", 0.1, 1)] * 10
+    wide = [tuple("x" * 1000 for _ in range(50))] * 10
+    assert estimate_fetch_batch_size(narrow, memory_target_bytes=1024 ** 2) > \
+        estimate_fetch_batch_size(wide, memory_target_bytes=1024 ** 2)
+    assert estimate_fetch_batch_size(wide, memory_target_bytes=1, min_rows=500) == 500
+    assert estimate_fetch_batch_size(narrow, memory_target_bytes=1024 ** 4, max_rows=10000) == 10000
+    assert estimate_fetch_batch_size([], min_rows=500) == 500
+
+
+def test_fetch_arrow_batches_keeps_order_and_types():
+    from source_scripts.preprocessing.preprocess import fetch_arrow_batches, fetch_pandas_arrow
+    cursor = FakeArrowCursor(batch_sizes=[3, 0, 5, 2])
+    table = fetch_arrow_batches(cursor, "SELECT * FROM abalone", max_workers=4)
+    assert table.column_names == ["sex", "length", "rings"]
+    assert table.num_rows == 10
+    assert table.column("rings").to_pylist() == list(range(10))
+    dataset = fetch_pandas_arrow(FakeArrowCursor(batch_sizes=[3, 5]), "SELECT * FROM abalone", max_workers=2)
+    assert str(dataset["length"].dtype) == "float64"
+    assert str(dataset["rings"].dtype) == "int64"
+    assert len(dataset) == 8
+
+
+def test_fetch_arrow_batches_empty_result():
+    from source_scripts.preprocessing.preprocess import fetch_arrow_batches
+    table = fetch_arrow_batches(FakeArrowCursor(batch_sizes=[]), "SELECT * FROM abalone")
+    assert table.num_rows == 0
+    assert table.column_names == ["sex", "length", "rings"]
+
+
+def test_build_select_query_athena_projection_and_filter():
+    from source_scripts.preprocessing.preprocess import build_select_query, query_predicates
+    predicates = query_predicates("athena", rings_filter="5")
+    query = build_select_query("athena", "ml_abalone", database="ml-test-datasets_rl", predicates=predicates)
+    assert query == (
+        'SELECT "sex", "length", "diameter", "height", "whole_weight", "shucked_weight", "viscera_weight", '
+        '"shell_weight", "rings" FROM "ml-test-datasets_rl"."ml_abalone" WHERE "rings" > 5;'
+    )
+
+
+def test_build_select_query_snowflake_time_window():
+    from source_scripts.preprocessing.preprocess import build_select_query, query_predicates
+    predicates = query_predicates("snowflake", rings_filter="disabled", time_column="created_at",
+                                  window_start="2023-05-01T10:00:00+02:00", window_end="2023-05-02")
+    query = build_select_query("snowflake", "ML_ABALONE", columns=["sex", "rings"], predicates=predicates)
+    assert query == (
+        "SELECT sex, rings FROM ML_ABALONE "
+        "WHERE created_at >= TO_TIMESTAMP_NTZ('2023-05-01 08:00:00.000') "
+        "AND created_at < TO_TIMESTAMP_NTZ('2023-05-02 00:00:00.000');"
+    )
+
+
+def test_query_predicates_athena_time_window_and_disabled_filter():
+    from source_scripts.preprocessing.preprocess import query_predicates
+    assert query_predicates("athena", rings_filter="disabled") == []
+    assert query_predicates("athena", time_column="ts", window_start="2023-05-01 00:00:00") == [
+        "\"ts\" >= timestamp '2023-05-01 00:00:00.000'"
+    ]
+    with pytest.raises(ValueError):
+        query_predicates("athena", rings_filter="1; DROP TABLE ml_abalone")
+
+
+def test_iter_parquet_chunks_local_store(tmp_path):
+    import pandas as pd
+    from source_scripts.preprocessing.preprocess import LocalParquetStore, iter_parquet_chunks, concat_chunks
+    write_parquet_parts(tmp_path, n_files=5, rows_per_file=250)
+    (tmp_path / "_SUCCESS").write_text("")
+    chunks = list(iter_parquet_chunks(LocalParquetStore(), str(tmp_path), chunksize=100, max_workers=2))
+    assert max(len(chunk) for chunk in chunks) == 100
+    dataset = concat_chunks(chunks)
+    assert len(dataset) == 1250
+    assert dataset["rings"].tolist() == list(range(1250))
+    assert isinstance(dataset, pd.DataFrame)
+
+
+def test_iter_parquet_chunks_column_subset_and_empty(tmp_path):
+    from source_scripts.preprocessing.preprocess import LocalParquetStore, iter_parquet_chunks, concat_chunks
+    write_parquet_parts(tmp_path / "parts", n_files=2, rows_per_file=10)
+    chunks = list(iter_parquet_chunks(LocalParquetStore(), str(tmp_path / "parts"), columns=["rings"]))
+    assert [list(chunk.columns) for chunk in chunks] == [["rings"], ["rings"]]
+    (tmp_path / "empty").mkdir()
+    empty = concat_chunks(iter_parquet_chunks(LocalParquetStore(), str(tmp_path / "empty")))
+    assert empty.empty
+    assert "rings" in empty.columns
+
+
+def test_fetch_incremental_only_fetches_rows_after_watermark(tmp_path):
+    import pandas as pd
+    from source_scripts.preprocessing.preprocess import fetch_incremental, read_ingestion_state
+    source = timestamped_abalone(n_rows=10, start="2023-05-01")
+    calls = []
+
+    def fetch_since(window_start, exclusive):
+        calls.append((window_start, exclusive))
+        if window_start is None:
+            return source.copy()
+        start = pd.Timestamp(window_start)
+        return source[source["created_at"] > start if exclusive else source["created_at"] >= start].copy()
+
+    first = fetch_incremental(fetch_since, str(tmp_path), "created_at")
+    assert len(first) == 10
+    assert read_ingestion_state(str(tmp_path))["watermark"] == "2023-05-10T00:00:00"
+
+    source = pd.concat([source, timestamped_abalone(n_rows=3, start="2023-05-11")], ignore_index=True)
+    second = fetch_incremental(fetch_since, str(tmp_path), "created_at")
+    assert calls[-1] == ("2023-05-10T00:00:00", True)
+    assert len(second) == 13
+    assert second["created_at"].is_unique
+    assert read_ingestion_state(str(tmp_path))["rows"] == 13
+
+    unchanged = fetch_incremental(fetch_since, str(tmp_path), "created_at")
+    assert len(unchanged) == 13
+
+
+def test_fetch_incremental_reloads_on_schema_change(tmp_path):
+    from source_scripts.preprocessing.preprocess import fetch_incremental, read_ingestion_state
+    source = timestamped_abalone(n_rows=5, start="2023-05-01")
+    fetch_incremental(lambda start, exclusive: source.copy(), str(tmp_path), "created_at")
+
+    changed = timestamped_abalone(n_rows=7, start="2023-05-01")
+    changed["rings"] = changed["rings"].astype("float64")
+    calls = []
+
+    def fetch_since(window_start, exclusive):
+        calls.append((window_start, exclusive))
+        return changed.copy() if window_start is None else changed.tail(2).copy()
+
+    dataset = fetch_incremental(fetch_since, str(tmp_path), "created_at")
+    assert calls[-1] == (None, False)
+    assert len(dataset) == 7
+    assert read_ingestion_state(str(tmp_path))["schema"]["rings"] == "float64"
+
+
+def test_normalize_sql_keeps_literals():
+    from source_scripts.preprocessing.preprocess import normalize_sql
+    assert normalize_sql("SELECT  sex,\n rings FROM t  WHERE sex = 'M  F' ;") == "SELECT sex, rings FROM t WHERE sex = 'M  F'"
+
+
+def test_query_result_cache_hit_miss_and_version(tmp_path):
+    from source_scripts.preprocessing.preprocess import QueryResultCache
+    cache = QueryResultCache(str(tmp_path))
+    dataset = timestamped_abalone(n_rows=6, start="2023-05-01")
+    assert cache.get("SELECT * FROM t;", "v1") is None
+    cache.put("SELECT * FROM t;", "v1", dataset)
+    cached = cache.get("SELECT *\n  FROM t", "v1")
+    assert cached.equals(dataset)
+    assert cache.get("SELECT * FROM t;", "v2") is None
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert [m["metric_value"] for m in cache.metrics("pipeline")] == [1.0, 2.0]
+
+
+def test_query_result_cache_ttl_and_lru_eviction(tmp_path):
+    import time
+    from source_scripts.preprocessing.preprocess import QueryResultCache
+    dataset = timestamped_abalone(n_rows=6, start="2023-05-01")
+    expired = QueryResultCache(str(tmp_path / "ttl"), ttl_seconds=0)
+    expired.put("SELECT 1", "v1", dataset)
+    time.sleep(0.01)
+    assert expired.get("SELECT 1", "v1") is None
+
+    cache = QueryResultCache(str(tmp_path / "lru"))
+    cache.put("SELECT 1", "v1", dataset)
+    entry_bytes = cache._read_index()[cache.key("SELECT 1", "v1")]["bytes"]
+    cache.max_bytes = 2 * entry_bytes
+    cache.put("SELECT 2", "v1", dataset)
+    assert cache.get("SELECT 1", "v1") is not None
+    cache.put("SELECT 3", "v1", dataset)
+    assert cache.get("SELECT 2", "v1") is None
+    assert cache.get("SELECT 1", "v1") is not None
+    assert len(list((tmp_path / "lru").glob("*.parquet"))) == 2
+
+
+def test_duckdb_reads_abalone_csv_offline():
+    from source_scripts.preprocessing.preprocess import (
+        build_select_query, duckdb_relation, fetch_duckdb_arrow, query_predicates
+    )
+    dataset_path = os.path.join(os.path.dirname(__file__), "..", "dataset", "abalone-dataset.csv")
+    query = build_select_query("duckdb", duckdb_relation(dataset_path),
+                               predicates=query_predicates("duckdb", rings_filter="20"))
+    table = fetch_duckdb_arrow(query)
+    assert table.column_names == ["sex", "length", "diameter", "height", "whole_weight", "shucked_weight",
+                                  "viscera_weight", "shell_weight", "rings"]
+    assert table.num_rows == 36
+    assert min(table.column("rings").to_pylist()) == 21
+    assert str(table.schema.field("length").type) == "double"
+
+
+def test_duckdb_reads_parquet_directory_with_time_window(tmp_path):
+    from source_scripts.preprocessing.preprocess import (
+        build_select_query, duckdb_relation, fetch_duckdb_arrow, query_predicates
+    )
+    timestamped_abalone(n_rows=10, start="2023-05-01").to_parquet(tmp_path / "part-0.parquet", index=False)
+    predicates = query_predicates("duckdb", time_column="created_at", window_start="2023-05-03",
+                                  window_end="2023-05-06")
+    query = build_select_query("duckdb", duckdb_relation(str(tmp_path)), columns=["rings", "created_at"],
+                               predicates=predicates)
+    assert query.startswith(f'SELECT "rings", "created_at" FROM read_parquet(\'{tmp_path}/**/*\') WHERE ')
+    assert fetch_duckdb_arrow(query).column("rings").to_pylist() == [2, 3, 4]
+
+
+def test_in_memory_data_source_streams_typed_batches():
+    import pyarrow as pa
+    from source_scripts.preprocessing.preprocess import create_data_source, query_predicates
+    data = timestamped_abalone(n_rows=12, start="2023-05-01")
+    source = create_data_source({"fetch_data_from": "memory", "chunksize": 5}, data=data)
+    predicates = query_predicates(source.backend, rings_filter="2")
+    batches = list(source.iter_batches(columns=["sex", "rings"], predicates=predicates))
+    assert [batch.num_rows for batch in batches] == [5, 4]
+    assert all(isinstance(batch, pa.RecordBatch) for batch in batches)
+    assert batches[0].schema.field("rings").type == pa.int64()
+    assert source.estimate_rows() == 12
+    assert source.schema().names == ["sex", "length", "rings", "created_at"]
+    assert source.schema(columns=["rings"]).names == ["rings"]
+    assert source.read(columns=["rings"], predicates=predicates)["rings"].tolist() == list(range(3, 12))
+
+
+def test_local_file_data_source_and_fetch_dataset_cache(tmp_path):
+    from source_scripts.preprocessing.preprocess import QueryResultCache, create_data_source, fetch_dataset
+    dataset_path = os.path.join(os.path.dirname(__file__), "..", "dataset", "abalone-dataset.csv")
+    source = create_data_source({"fetch_data_from": "local", "duckdb_path": dataset_path})
+    assert source.estimate_rows() == 4177
+    cache = QueryResultCache(str(tmp_path))
+    first = fetch_dataset(source, cache=cache)
+    second = fetch_dataset(source, cache=cache)
+    assert len(first) == 4177
+    assert second.equals(first)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_register_data_source_without_editing_main():
+    import pyarrow as pa
+    import pytest
+    from source_scripts.preprocessing import preprocess
+
+    @preprocess.register_data_source("test-constant")
+    class ConstantDataSource(preprocess.DataSource):
+        backend = "duckdb"
+
+        def iter_batches(self, columns=None, predicates=()):
+            yield pa.RecordBatch.from_pydict({"rings": [1, 2]})
+
+    try:
+        source = preprocess.create_data_source({"fetch_data_from": "test-constant"})
+        assert isinstance(source, ConstantDataSource)
+        assert source.read()["rings"].tolist() == [1, 2]
+    finally:
+        del preprocess.DATA_SOURCES["test-constant"]
+    with pytest.raises(ValueError):
+        preprocess.create_data_source({"fetch_data_from": "test-constant"})
+
+
+def test_athena_submit_before_the_packages_are_needed(monkeypatch):
+    import pandas as pd
+    from source_scripts.preprocessing import preprocess
+    client = FakeAthenaClient()
+    source = preprocess.AthenaDataSource({}, database="db", table="abalone", env_type="dev")
+    predicates = preprocess.query_predicates("athena", rings_filter="9")
+    assert source.submit(predicates=predicates, client=client) == "execution-1"
+    assert client.started[0]["QueryString"] == source.query(predicates=predicates)
+    assert client.started[0]["WorkGroup"] == "dev-athena-workgroup"
+
+    waited = []
+    monkeypatch.setattr(preprocess.wr.athena, "wait_query", lambda query_execution_id: waited.append(query_execution_id))
+    monkeypatch.setattr(preprocess.wr.athena, "get_query_results",
+                        lambda query_execution_id, chunksize: iter([pd.DataFrame({"rings": [10, 11]})]))
+    dataset = source.read(predicates=predicates)
+    assert waited == ["execution-1"]
+    assert dataset["rings"].tolist() == [10, 11]
+
+
+def test_streaming_preprocessor_matches_in_memory_path():
+    import numpy as np
+    from source_scripts.preprocessing.preprocess import StreamingPreprocessor, preprocess_abalone
+    dataset = abalone_frame()
+    dataset.loc[::50, "length"] = np.nan
+    dataset.loc[::70, "sex"] = np.nan
+    preprocessor = StreamingPreprocessor()
+    for start in range(0, len(dataset), 500):
+        preprocessor.partial_fit(dataset[start:start + 500])
+    preprocessor.finish()
+    streamed = np.concatenate([preprocessor.transform(dataset[start:start + 500])
+                               for start in range(0, len(dataset), 500)])
+    in_memory = np.concatenate(preprocess_abalone(dataset.copy()))
+    assert streamed.shape == in_memory.shape == (4177, 12)
+    np.testing.assert_allclose(sort_rows(streamed), sort_rows(in_memory), rtol=1e-9, atol=1e-9)
+
+
+def test_quantile_sketch_merges_and_stays_close_after_compaction():
+    import numpy as np
+    from source_scripts.preprocessing.preprocess import QuantileSketch
+    values = np.random.RandomState(1).lognormal(size=200000)
+    left = QuantileSketch(capacity=2048).update(values[:120000])
+    right = QuantileSketch(capacity=2048, seed=1)
+    for start in range(120000, len(values), 10000):
+        right.update(values[start:start + 10000])
+    sketch = left.merge(right)
+    assert sketch.count() == len(values)
+    assert sum(len(level) for level in sketch.levels) < 20000
+    for q in (0.1, 0.5, 0.9):
+        assert abs((values < sketch.quantile(q)).mean() - q) < 0.01
+    assert QuantileSketch().update([3.0, np.nan, 1.0, 2.0, 10.0]).quantile(0.5) == 2.5
+
+
+def test_preprocess_abalone_out_of_core_writes_splits(tmp_path):
+    import numpy as np
+    import pandas as pd
+    from source_scripts.preprocessing.preprocess import preprocess_abalone_out_of_core
+    dataset = abalone_frame()
+    outputs = {name: str(tmp_path / name / f"{name}.csv") for name in ("raw", "train", "validation", "test")}
+    preprocessor, counts = preprocess_abalone_out_of_core(
+        lambda: (dataset[start:start + 1000] for start in range(0, len(dataset), 1000)), outputs)
+    assert counts["raw"] == len(dataset)
+    assert counts["train"] + counts["validation"] + counts["test"] == len(dataset)
+    assert 0.65 < counts["train"] / len(dataset) < 0.75
+    splits = [pd.read_csv(outputs[name], header=None).to_numpy() for name in ("train", "validation", "test")]
+    everything = np.concatenate([preprocessor.transform(dataset[start:start + 1000])
+                                 for start in range(0, len(dataset), 1000)])
+    np.testing.assert_allclose(sort_rows(np.concatenate(splits)), sort_rows(everything), rtol=1e-9)
+
+    preprocess_abalone_out_of_core(lambda: iter([dataset]), {"test": outputs["test"]}, include_label=False)
+    assert pd.read_csv(outputs["test"], header=None).shape[1] == 10
+
+
+def test_saved_training_preprocessor_reproduces_the_fitted_transform(tmp_path):
+    import numpy as np
+    from source_scripts.preprocessing.preprocess import StreamingPreprocessor, preprocess_abalone
+    dataset = abalone_frame()
+    dataset.loc[::40, "whole_weight"] = np.nan
+    splits, preprocessor = preprocess_abalone(dataset.copy(), return_preprocessor=True)
+    preprocessor.save(str(tmp_path / "preprocessor" / "preprocessor.json"))
+    loaded = StreamingPreprocessor.load(str(tmp_path / "preprocessor" / "preprocessor.json"))
+    np.testing.assert_allclose(sort_rows(loaded.transform(dataset)), sort_rows(np.concatenate(splits)),
+                               rtol=1e-12, atol=1e-12)
+
+
+def test_transform_abalone_keeps_every_row_in_order(tmp_path):
+    import numpy as np
+    import pandas as pd
+    from source_scripts.preprocessing.preprocess import StreamingPreprocessor, transform_abalone
+    dataset = abalone_frame()
+    preprocessor = StreamingPreprocessor().partial_fit(dataset).finish()
+    unlabeled = dataset.drop(columns=["rings"])
+    unlabeled.loc[0, "sex"] = "unknown"
+    output_path = str(tmp_path / "inference-test" / "inference-data.csv")
+    rows = transform_abalone((unlabeled[start:start + 1000] for start in range(0, len(unlabeled), 1000)),
+                             preprocessor, output_path)
+    written = pd.read_csv(output_path, header=None).to_numpy()
+    assert rows == len(written) == len(dataset)
+    np.testing.assert_allclose(written[1:], preprocessor.transform(dataset)[1:, 1:])
+    assert written[0, -3:].tolist() == [0.0, 0.0, 0.0]
+
+
+def test_transform_plan_matches_sklearn_column_transformer():
+    import numpy as np
+    from source_scripts.preprocessing.preprocess import StreamingPreprocessor, abalone_column_transformer
+    dataset = abalone_frame()
+    dataset.loc[::30, "diameter"] = np.nan
+    dataset.loc[::45, "sex"] = np.nan
+    dataset["height"] = 0.1  # zero variance, scaled by 1 like StandardScaler
+    features = dataset.drop(columns=["rings"])
+    column_transformer = abalone_column_transformer().fit(features)
+    preprocessor = StreamingPreprocessor.from_column_transformer(column_transformer)
+    expected = column_transformer.transform(features)
+    np.testing.assert_allclose(preprocessor.features(features), expected, rtol=1e-12, atol=1e-12)
+    chunked = np.concatenate([preprocessor.features(features[start:start + 333])
+                              for start in range(0, len(features), 333)])
+    np.testing.assert_allclose(chunked, expected, rtol=1e-12, atol=1e-12)
+    labeled = preprocessor.transform(dataset)
+    np.testing.assert_array_equal(labeled[:, 0], dataset["rings"].to_numpy(dtype=float))
+    np.testing.assert_allclose(labeled[:, 1:], expected, rtol=1e-12, atol=1e-12)
+
+
+def test_transform_plan_unknown_categories_and_preallocated_output():
+    import numpy as np
+    from source_scripts.preprocessing.preprocess import StreamingPreprocessor, abalone_column_transformer
+    features = abalone_frame().drop(columns=["rings"])
+    column_transformer = abalone_column_transformer().fit(features[features["sex"] != "I"])
+    preprocessor = StreamingPreprocessor.from_column_transformer(column_transformer)
+    out = np.full((len(features), 9), np.nan)
+    result = preprocessor.features(features, out=out)
+    assert result is out
+    np.testing.assert_allclose(out, column_transformer.transform(features), rtol=1e-12, atol=1e-12)
+    assert not out[(features["sex"] == "I").to_numpy(), -2:].any()
+
+
+def test_preprocess_abalone_lean_float32_matrix_and_index_splits(tmp_path):
+    import numpy as np
+    import pandas as pd
+    from source_scripts.preprocessing.preprocess import (
+        StreamingPreprocessor, abalone_column_transformer, preprocess_abalone_lean, write_rows
+    )
+    dataset = abalone_frame()
+    dataset.loc[::25, "shell_weight"] = np.nan
+    X, splits, preprocessor = preprocess_abalone_lean(dataset)
+    assert X.dtype == np.float32
+    assert 0.65 < len(splits[0]) / len(dataset) < 0.75
+    assert sorted(np.concatenate(splits).tolist()) == list(range(len(dataset)))
+
+    reference = StreamingPreprocessor.from_column_transformer(
+        abalone_column_transformer().fit(dataset.drop(columns=["rings"])))
+    for name in ("medians", "means", "scales"):
+        np.testing.assert_allclose(list(getattr(preprocessor, name).values()),
+                                   list(getattr(reference, name).values()), rtol=1e-12)
+    np.testing.assert_allclose(X, reference.transform(dataset), rtol=1e-6, atol=1e-6)
+
+    write_rows(str(tmp_path / "validation.csv"), X, splits[1], chunk_rows=100)
+    written = pd.read_csv(tmp_path / "validation.csv", header=None).to_numpy()
+    np.testing.assert_allclose(written, X[splits[1]], rtol=1e-6)
+
+
+def test_hash_splits_do_not_depend_on_row_order():
+    import numpy as np
+    from source_scripts.preprocessing.preprocess import hash_split_indices
+    dataset = abalone_frame()
+    dataset["id"] = np.arange(len(dataset))
+    shuffled = dataset.sample(frac=1, random_state=3).reset_index(drop=True)
+    for key in (None, ["id"]):
+        original = [set(dataset["id"].to_numpy()[indices]) for indices in hash_split_indices(dataset, key)]
+        reordered = [shuffled["id"].to_numpy()[indices] for indices in hash_split_indices(shuffled, key)]
+        assert [set(ids) for ids in reordered] == original
+        assert 0.68 < len(original[0]) / len(dataset) < 0.72
+        assert 0.13 < len(original[1]) / len(dataset) < 0.17
+
+    # new rows only append, the rows already assigned stay in their split
+    grown = hash_split_indices(dataset.iloc[:3000], ["id"])
+    full = hash_split_indices(dataset, ["id"])
+    for before, after in zip(grown, full):
+        assert set(before) <= set(after)
+
+
+def test_preprocess_abalone_reruns_are_byte_identical(tmp_path):
+    import pandas as pd
+    from source_scripts.preprocessing.preprocess import preprocess_abalone
+    dataset = abalone_frame()
+    outputs = []
+    for run, frame in enumerate((dataset, dataset.sample(frac=1, random_state=7).reset_index(drop=True))):
+        for name, split in zip(("train", "validation", "test"), preprocess_abalone(frame.copy())):
+            pd.DataFrame(split).to_csv(tmp_path / f"{name}-{run}.csv", header=False, index=False)
+    for name in ("train", "validation", "test"):
+        assert (tmp_path / f"{name}-0.csv").read_bytes() == (tmp_path / f"{name}-1.csv").read_bytes()
+
+
 def generate_abalone_csv(filepath):
     from pandas import DataFrame
     from sklearn.datasets import make_classification
@@ -143,8 +605,109 @@ def generate_abalone_csv(filepath):
     df.to_csv(filepath, header=False, index=False)
 
 
+def write_parquet_parts(directory, n_files, rows_per_file):
+    """Writes n_files extension-less Parquet parts like an Athena UNLOAD, rings numbered across files."""
+    import pathlib
+    import pandas as pd
+    pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+    for i in range(n_files):
+        offset = i * rows_per_file
+        pd.DataFrame({
+            "sex": ["M"] * rows_per_file,
+            "length": [0.5] * rows_per_file,
+            "rings": range(offset, offset + rows_per_file),
+        }).to_parquet(pathlib.Path(directory) / f"part-{i:05d}", index=False)
+
+
+def timestamped_abalone(n_rows, start):
+    """Abalone shaped rows with one created_at day per row, starting at start."""
+    import pandas as pd
+    return pd.DataFrame({
+        "sex": ["M", "F", "I"] * (n_rows // 3) + ["M"] * (n_rows % 3),
+        "length": [0.5] * n_rows,
+        "rings": range(n_rows),
+        "created_at": pd.date_range(start, periods=n_rows, freq="D"),
+    })
+
+
+def abalone_frame():
+    import pandas as pd
+    dataset_path = os.path.join(os.path.dirname(__file__), "..", "dataset", "abalone-dataset.csv")
+    return pd.read_csv(dataset_path, header=None, names=["sex", "length", "diameter", "height", "whole_weight",
+                                                          "shucked_weight", "viscera_weight", "shell_weight",
+                                                          "rings"])
+
+
+def sort_rows(matrix):
+    import numpy as np
+    # rounded keys, so that rows equal up to float noise sort the same way
+    return matrix[np.lexsort(np.round(matrix, 6).T[::-1])]
+
+
 def sagemaker_local_session():
     from sagemaker.local import LocalSession
     sagemaker_session = LocalSession()
     sagemaker_session.config = {'local': {'local_code': True}}
     return sagemaker_session
+
+
+class FakeCursor:
+    """DB-API cursor stand-in returning n_rows rows of (sex, length, rings)."""
+
+    def __init__(self, n_rows):
+        from collections import namedtuple
+        column = namedtuple("Column", ["name"])
+        self.description = [column("SEX"), column("LENGTH"), column("RINGS")]
+        self.rows = [("M", 0.5, i) for i in range(n_rows)]
+        self.position = 0
+        self.requested = []
+
+    def execute(self, sql):
+        self.position = 0
+
+    def fetchmany(self, size):
+        self.requested.append(size)
+        batch = self.rows[self.position:self.position + size]
+        self.position += len(batch)
+        return batch
+
+
+class FakeResultBatch:
+    """Stands in for a snowflake.connector ResultBatch, rows are numbered from offset."""
+
+    def __init__(self, offset, n_rows):
+        self.offset = offset
+        self.rowcount = n_rows
+
+    def to_arrow(self):
+        import pyarrow as pa
+        if self.rowcount == 0:
+            return None
+        return pa.table({
+            "SEX": ["M"] * self.rowcount,
+            "LENGTH": [0.5] * self.rowcount,
+            "RINGS": list(range(self.offset, self.offset + self.rowcount)),
+        })
+
+
+class FakeArrowCursor(FakeCursor):
+    """Cursor stand-in exposing get_result_batches with the given batch sizes."""
+
+    def __init__(self, batch_sizes):
+        super().__init__(n_rows=0)
+        offsets = [sum(batch_sizes[:i]) for i in range(len(batch_sizes))]
+        self.batches = [FakeResultBatch(offset, n_rows) for offset, n_rows in zip(offsets, batch_sizes)]
+
+    def get_result_batches(self):
+        return self.batches
+
+
+class FakeAthenaClient:
+    """boto3 athena client stand-in recording start_query_execution calls."""
+
+    def __init__(self):
+        self.started = []
+
+    def start_query_execution(self, **kwargs):
+        self.started.append(kwargs)
+        return {"QueryExecutionId": f"execution-{len(self.started)}"}